@@ -0,0 +1,70 @@
+"""
+Measures how many queued batches ``emit_notices`` works through per second.
+
+    python benchmark.py [--users=N] [--batches=N]
+
+Each batch is queued for ``--users`` users, like a notice sent to a group of
+followers. Run it before and after a change to the sending path to compare.
+"""
+import optparse
+import time
+
+from django.conf import settings
+
+settings.configure(
+    DEBUG=False,
+    USE_TZ=True,
+    DATABASES={
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": ":memory:",
+        }
+    },
+    ROOT_URLCONF="notification.urls",
+    INSTALLED_APPS=[
+        "django.contrib.auth",
+        "django.contrib.contenttypes",
+        "django.contrib.sites",
+        "notification",
+    ],
+    EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+    SITE_ID=1,
+    PRODUCTION_SETTING=True,
+    DEVELOPMENT_SERVER=False,
+    DEFAULT_PROFILE_PHOTO="",
+    TIME_INTERVAL_BTW_TWO_NOTIFICATION=10,
+)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--users", type="int", default=100)
+    parser.add_option("--batches", type="int", default=50)
+    options, args = parser.parse_args()
+
+    from django.core.management import call_command
+    from django.contrib.auth.models import User
+
+    from notification.engine import send_all
+    from notification.models import create_notice_type, queue
+
+    call_command("syncdb", interactive=False, verbosity=0)
+    create_notice_type("benchmark", "Benchmark", "benchmarked", "benchmark notice", verbosity=0)
+    users = [
+        User.objects.create_user("user%s" % i, "user%s@example.com" % i, "password")
+        for i in range(options.users)
+    ]
+    for i in range(options.batches):
+        # a sender per batch, so that no batch is suppressed as a duplicate
+        sender = User.objects.create_user("sender%s" % i, "sender%s@example.com" % i, "password")
+        queue(users, "benchmark", {"batch": i}, sender=sender)
+
+    start = time.time()
+    send_all()
+    elapsed = time.time() - start
+    print("%s batches of %s users in %.2f seconds, %.1f batches per second" % (
+        options.batches, options.users, elapsed, options.batches / elapsed))
+
+
+if __name__ == "__main__":
+    main()
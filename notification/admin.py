@@ -1,6 +1,9 @@
 from django.contrib import admin
 
+from django.utils.translation import ugettext_lazy as _
+
 from notification.models import NoticeType, NoticeSetting, Notice, NoticeQueueBatch
+from notification.models import NoticeQueueDeadLetter
 from notification.forms import NoticeSettingForm
 
 
@@ -19,7 +22,20 @@ class NoticeAdmin(admin.ModelAdmin):
     list_display = ["message", "recipient", "sender", "notice_type", "added", "unseen", "archived", "on_site"]
 
 
+class NoticeQueueDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ["id", "failed", "attempts"]
+    readonly_fields = ["failed", "attempts", "progress", "last_error"]
+    exclude = ["pickled_data", "payload"]
+    actions = ["requeue"]
+
+    def requeue(self, request, queryset):
+        for dead_letter in queryset:
+            dead_letter.requeue()
+    requeue.short_description = _("Queue selected batches again")
+
+
 admin.site.register(NoticeQueueBatch)
+admin.site.register(NoticeQueueDeadLetter, NoticeQueueDeadLetterAdmin)
 admin.site.register(NoticeType, NoticeTypeAdmin)
 admin.site.register(NoticeSetting, NoticeSettingAdmin)
 admin.site.register(Notice, NoticeAdmin)
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""
+Recipients of queued notices which are only looked up when they are sent.
+
+``queue`` accepts, besides a list of users, a QuerySet of users or an
+``Audience`` naming a registered function which returns one::
+
+    from notification import audiences
+
+    @audiences.register("group_members")
+    def group_members(group_id):
+        return User.objects.filter(groups__id=group_id)
+
+    notification.queue(audiences.Audience("group_members", group.pk), "group_news")
+
+Either way only the definition of the recipients is stored, so queueing takes
+the same time whatever the number of recipients. The ``emit_notices`` worker
+claiming such a batch first splits it into batches for consecutive primary
+key ranges of at most ``NOTIFICATION_QUEUE_BATCH_SIZE`` recipients, which
+other workers can share, and walks each range in primary key order, a chunk
+at a time. Audiences must be registered in a module the worker imports, such
+as an app's ``models.py``.
+"""
+import copy
+
+from django.db.models.query import ValuesQuerySet
+
+
+_registry = {}
+
+
+def register(name, func=None):
+    """
+    Registers ``func`` as the audience ``name``. Can be used as a decorator.
+    """
+    if func is None:
+        def decorator(func):
+            register(name, func)
+            return func
+        return decorator
+    _registry[name] = func
+
+
+class BaseAudience(object):
+    # the audience is limited to the primary keys above ``after`` up to and
+    # including ``upto``, None meaning no limit
+    after = upto = None
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def is_split(self):
+        """
+        Returns whether the audience is limited to a range of primary keys.
+        """
+        return self.after is not None or self.upto is not None
+
+    def get_pks(self):
+        """
+        Returns the primary keys of the recipients within the audience's
+        range, in ascending order.
+        """
+        queryset = self.get_queryset()
+        if self.after is not None:
+            queryset = queryset.filter(pk__gt=self.after)
+        if self.upto is not None:
+            queryset = queryset.filter(pk__lte=self.upto)
+        return queryset.order_by("pk").values_list("pk", flat=True)
+
+    def split(self, size):
+        """
+        Returns copies of the audience limited to consecutive ranges of at
+        most ``size`` of its recipients, which together cover all of it.
+        Costs one query per range.
+        """
+        pks = self.get_pks()
+        shards = []
+        after = self.after
+        while True:
+            page = pks if after is None else pks.filter(pk__gt=after)
+            shard = copy.copy(self)
+            shard.after = after
+            # the last primary key of this range and whether any follow it
+            bounds = list(page[size - 1:size + 1])
+            if len(bounds) < 2:
+                shard.upto = self.upto
+                shards.append(shard)
+                return shards
+            shard.upto = after = bounds[0]
+            shards.append(shard)
+
+    def iter_chunks(self, size, after=None):
+        """
+        Yields lists of at most ``size`` primary keys of the recipients in
+        ascending order, starting after the primary key ``after``.
+        """
+        queryset = self.get_pks()
+        while True:
+            page = queryset if after is None else queryset.filter(pk__gt=after)
+            pks = list(page[:size])
+            if not pks:
+                return
+            yield pks
+            after = pks[-1]
+
+
+class QueryAudience(BaseAudience):
+    """
+    The users selected by a QuerySet, stored as its pickled query.
+    """
+    def __init__(self, queryset):
+        self.query = queryset.query
+
+    @staticmethod
+    def supports(queryset):
+        """
+        Returns whether ``queryset`` can be stored and walked in primary key
+        order later, which sliced, distinct and ``values()`` QuerySets cannot.
+        """
+        query = queryset.query
+        if query.low_mark or query.high_mark is not None or query.distinct:
+            return False
+        return not isinstance(queryset, ValuesQuerySet)
+
+    def get_queryset(self):
+        queryset = self.query.model._default_manager.all()  # pylint: disable-msg=W0212
+        queryset.query = self.query
+        return queryset
+
+
+class Audience(BaseAudience):
+    """
+    The users returned by the function registered as ``name`` when called
+    with ``args`` and ``kwargs``.
+    """
+    def __init__(self, name, *args, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+
+    def get_queryset(self):
+        try:
+            func = _registry[self.name]
+        except KeyError:
+            raise LookupError("no audience registered as {!r}".format(self.name))
+        return func(*self.args, **self.kwargs)
@@ -1,4 +1,5 @@
 import sys
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.core import exceptions
@@ -51,3 +52,18 @@ def load_media_defaults(backends):
         media.append(key)
         defaults[key[0]] = backend.spam_sensitivity
     return media, defaults
+
+
+@contextmanager
+def opened(backends):
+    """
+    Keeps the given backends open, e.g. with a pooled SMTP connection, for
+    the duration of the block.
+    """
+    for backend in backends:
+        backend.open()
+    try:
+        yield
+    finally:
+        for backend in backends:
+            backend.close()
@@ -1,9 +1,17 @@
 from django.conf import settings
-from django.template import Context
-from django.template.loader import render_to_string
+from django.utils import six
+from django.utils import timezone
+from django.utils import translation
 
 from django.contrib.sites.models import Site
 
+from notification.rendering import MessageRenderer, TrackingContext
+from notification.utils import bulk_insert_ignore, chunks
+
+
+# how many Notice rows to insert per bulk_create statement
+BULK_CREATE_SIZE = getattr(settings, "NOTIFICATION_BULK_CREATE_SIZE", 500)
+
 
 class BaseBackend(object):
     """
@@ -14,15 +22,54 @@ class BaseBackend(object):
         if spam_sensitivity is not None:
             self.spam_sensitivity = spam_sensitivity
 
+    def open(self):
+        """
+        Called before a batch of deliveries; backends holding connections to
+        external services keep them open until the matching ``close``.
+        """
+        pass
+
+    def close(self):
+        """
+        Called once a batch of deliveries is done.
+        """
+        pass
+
     def can_send(self, user, notice_type):
         """
         Determines whether this backend is allowed to send a notification to
         the given user and notice_type.
         """
-        from notification.models import NoticeSetting
+        from notification import preferences
         if notice_type.state < 1:
             return False
-        return NoticeSetting.for_user(user, notice_type, self.medium_id).send
+        return preferences.can_send(user, notice_type, self.medium_id)
+
+    def can_send_many(self, users, notice_type, send_flags):
+        """
+        Bulk counterpart of ``can_send``. Returns the subset of ``users`` this
+        backend is allowed to deliver ``notice_type`` to, given the
+        ``send_flags`` computed by ``preferences.send_flags``.
+
+        Backends which override ``can_send`` without also overriding this
+        method get ``can_send`` called for each user, so their own rules
+        still apply.
+        """
+        if notice_type.state < 1:
+            return []
+        if self.overrides_can_send():
+            return [user for user in users if self.can_send(user, notice_type)]
+        return [user for user in users if send_flags[(user.pk, self.medium_id)]]
+
+    def overrides_can_send(self):
+        """
+        Returns whether ``can_send`` was overridden in a subclass of the class
+        which defines the ``can_send_many`` in use.
+        """
+        def owner(name):
+            return next(cls for cls in type(self).__mro__ if name in vars(cls))
+        can_send, can_send_many = owner("can_send"), owner("can_send_many")
+        return can_send is not can_send_many and issubclass(can_send, can_send_many)
 
     def deliver(self, recipient, sender, notice_type, extra_context):
         """
@@ -30,26 +77,121 @@ class BaseBackend(object):
         """
         raise NotImplementedError()
 
-    def get_formatted_messages(self, formats, label, context):
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        """
+        Deliver a notification to each of the given recipients.
+
+        Backends able to batch their reads, renders and writes override this;
+        by default ``deliver`` is called for each recipient in turn.
+        """
+        for recipient in recipients:
+            self.deliver(recipient, sender, notice_type, extra_context)
+
+    def partition_by_language(self, recipients, extra_context):
+        """
+        Returns ``(language_code, recipients)`` groups, see
+        ``notification.models.partition_by_language``.
+        """
+        from notification.models import partition_by_language, DEFAULT_LANGUAGE
+        return [
+            (language or DEFAULT_LANGUAGE, group)
+            for language, group in partition_by_language(recipients, extra_context)
+        ]
+
+    def activate_language(self, language_code, extra_context):
+        """
+        Activates ``language_code`` and switches a translatable
+        ``extra_context['target']`` over to it.
+        """
+        translation.activate(language_code)
+        if 'target' in extra_context and hasattr(extra_context['target'], 'translations'):
+            from general.utils import switch_language
+            target = extra_context['target']
+            extra_context['target'] = switch_language(target, language_code)
+
+    def exclude_duplicates(self, notices):
+        """
+        Fills in the ``dedupe_key`` of the given unsaved Notice instances and
+        returns those which duplicate neither a stored notice, i.e. one sent
+        within the last ``TIME_INTERVAL_BTW_TWO_NOTIFICATION`` minutes, nor
+        one before them in ``notices``. Reads the stored keys in chunks of
+        ``NOTIFICATION_BULK_CREATE_SIZE``.
+        """
+        from notification.models import Notice
+        now = timezone.now()
+        for notice in notices:
+            if notice.dedupe_key is None:
+                notice.dedupe_key = notice.get_dedupe_key(now)
+        keys = [notice.dedupe_key for notice in notices if notice.dedupe_key is not None]
+        seen = set()
+        for chunk in chunks(keys, BULK_CREATE_SIZE):
+            stored = Notice.objects.filter(dedupe_key__in=chunk)
+            seen.update(stored.values_list("dedupe_key", flat=True))
+        fresh = []
+        for notice in notices:
+            if notice.dedupe_key is not None:
+                if notice.dedupe_key in seen:
+                    continue
+                seen.add(notice.dedupe_key)
+            fresh.append(notice)
+        return fresh
+
+    def create_notices(self, notices):
+        """
+        Inserts the given unsaved Notice instances in chunks of
+        ``NOTIFICATION_BULK_CREATE_SIZE`` and returns those actually written.
+
+        Notices whose ``dedupe_key`` already exists, i.e. which duplicate one
+        sent within the last ``TIME_INTERVAL_BTW_TWO_NOTIFICATION`` minutes,
+        are skipped.
+        """
+        from notification.models import Notice
+        now = timezone.now()
+        for notice in notices:
+            if notice.dedupe_key is None:
+                notice.dedupe_key = notice.get_dedupe_key(now)
+        return bulk_insert_ignore(Notice, notices, BULK_CREATE_SIZE, ("dedupe_key",))
+
+    def get_formatted_messages(self, formats, label, context, renderer=None):
         """
         Returns a dictionary with the format identifier as the key. The values are
         are fully rendered templates with the given context.
+
+        ``label`` may be a sequence of labels whose ``notification/<label>/<format>``
+        templates are tried in turn before ``notification/<format>``. Pass the
+        same ``renderer`` for every recipient of a notice so output which does
+        not depend on the recipient is only rendered once per language.
         """
+        if isinstance(label, six.string_types):
+            labels = (label,)
+        else:
+            labels = tuple(label)
+        if renderer is None:
+            renderer = MessageRenderer()
         format_templates = {}
         for fmt in formats:
             # conditionally turn off autoescaping for .txt extensions in format
             if fmt.endswith(".txt"):
                 context.autoescape = False
-            format_templates[fmt] = render_to_string((
-                "notification/%s/%s" % (label, fmt),
-                "notification/%s" % fmt), context_instance=context)
+            template_names = tuple("notification/%s/%s" % (name, fmt) for name in labels)
+            template_names += ("notification/%s" % fmt,)
+            format_templates[fmt] = renderer.render(template_names, context)
         return format_templates
 
+    def get_labels(self, notice_type, context):
+        """
+        Returns the labels to look notification templates up by: the context's
+        ``app_label`` if there is one, then the notice type's label.
+        """
+        if "app_label" in context:
+            return (context["app_label"], notice_type.label)
+        return (notice_type.label,)
+
     def default_context(self):
         default_http_protocol = getattr(settings, "DEFAULT_HTTP_PROTOCOL", "http")
         current_site = Site.objects.get_current()
         base_url = "%s://%s" % (default_http_protocol, current_site.domain)
-        return Context({
+        return TrackingContext({
             "default_http_protocol": '%s:' % default_http_protocol,
             "current_site": current_site,
             "current_site_name": current_site.name,
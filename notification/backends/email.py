@@ -1,47 +1,96 @@
+import socket
+import smtplib
+import threading
+
 from django.conf import settings
-from django.core.mail import send_mail
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.mail import EmailMessage, get_connection
 from django.contrib.auth.models import User
-from django.template.loader import render_to_string
 from django.utils.translation import ugettext
-from django.utils import translation
-from django.utils import timezone
 
 from notification import backends
+from notification.rendering import MessageRenderer
+
+
+# number of messages sent over one mail connection before it is recycled
+MESSAGES_PER_CONNECTION = getattr(settings, "NOTIFICATION_EMAIL_MESSAGES_PER_CONNECTION", 100)
 
 
 class EmailBackend(backends.BaseBackend):
     spam_sensitivity = 0
 
+    def __init__(self, *args, **kwargs):
+        super(EmailBackend, self).__init__(*args, **kwargs)
+        # backends are shared module level instances, keep the pooled
+        # connection per thread
+        self._local = threading.local()
+
+    def open(self):
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+
+    def close(self):
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self.reset_connection()
+
+    def get_connection(self):
+        """
+        Returns the pooled mail connection, opening a new one when there is
+        none yet or the current one has sent ``MESSAGES_PER_CONNECTION``.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.sent >= MESSAGES_PER_CONNECTION:
+            self.reset_connection()
+            connection = get_connection()
+            connection.open()
+            self._local.connection = connection
+            self._local.sent = 0
+        return connection
+
+    def reset_connection(self):
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+    def send_messages(self, messages, sent=None):
+        """
+        Sends the given EmailMessages over the pooled connection. A message
+        which fails is retried once over a fresh connection. Every message
+        accepted is appended to ``sent``, which tells a caller how far it got
+        when an error is raised.
+        """
+        self.open()
+        try:
+            for message in messages:
+                try:
+                    self.get_connection().send_messages([message])
+                except (smtplib.SMTPException, socket.error):
+                    self.reset_connection()
+                    self.get_connection().send_messages([message])
+                self._local.sent += 1
+                if sent is not None:
+                    sent.append(message)
+        finally:
+            self.close()
+
     def can_send(self, user, notice_type):
         can_send = super(EmailBackend, self).can_send(user, notice_type)
         if can_send and user.email:
             return True
         return False
 
-    def deliver(self, recipient, sender, notice_type, extra_context):
-        # TODO: require this to be passed in extra_context
-        from notification.models import Notice
-        #postman stuff
-        recipient = User.objects.get(id=recipient.id)
-        language_code = 'en'
-        if 'language_code' in extra_context.keys():
-            for language_tuple in settings.LANGUAGES:
-                if extra_context['language_code'] in language_tuple:
-                    language_code = language_tuple[0]
-                    break
-        else:
-            try:
-                language_code = recipient.user_profile.default_language
-            except ObjectDoesNotExist:
-                language_code = 'en'
+    def can_send_many(self, users, notice_type, send_flags):
+        users = super(EmailBackend, self).can_send_many(users, notice_type, send_flags)
+        return [user for user in users if user.email]
 
-        translation.activate(language_code)
-        if 'target' in extra_context and hasattr(extra_context['target'], 'translations'):
-            from general.utils import switch_language
-            target = extra_context['target']
-            extra_context['target'] = switch_language(target, language_code)
+    def deliver(self, recipient, sender, notice_type, extra_context):
+        self.deliver_many([recipient], sender, notice_type, extra_context)
 
+    def deliver_many(self, recipients, sender, notice_type, extra_context):
+        # TODO: require this to be passed in extra_context
         if 'disallow_notice' in extra_context:
             if 'email' in extra_context['disallow_notice']:
                 return
@@ -49,8 +98,73 @@ class EmailBackend(backends.BaseBackend):
         if 'pm_message' in extra_context:
             sender = extra_context['pm_message'].sender
 
-        target_url = self.get_target_url(extra_context, sender, recipient)
+        pairs = self.render_notices(recipients, sender, notice_type, extra_context)
+        if not settings.PRODUCTION_SETTING:
+            # outside production every message goes to the admins instead
+            admins = [self.format_address(user) for user in self.get_admins()]
+            self.send_messages([
+                EmailMessage(message.subject, message.body, message.from_email, [admin])
+                for _, message in pairs
+                for admin in admins
+            ])
+            return
+
+        # only mail the recipients whose notice is not a duplicate, and store
+        # the notices of the messages accepted only after mailing them: a
+        # notice stored for a message that failed would suppress its retry
+        fresh = self.exclude_duplicates([notice for notice, _ in pairs])
+        fresh = set(id(notice) for notice in fresh)
+        pairs = [(notice, message) for notice, message in pairs if id(notice) in fresh]
+        sent = []
+        try:
+            self.send_messages([message for _, message in pairs], sent)
+        finally:
+            accepted = set(id(message) for message in sent)
+            self.create_notices([notice for notice, message in pairs if id(message) in accepted])
+
+    def render_notices(self, recipients, sender, notice_type, extra_context):
+        """
+        Returns a ``(notice, message)`` pair of an unsaved Notice and the
+        EmailMessage carrying it for each active recipient.
+        """
+        from notification.models import Notice
 
+        notice_sender = sender
+        if sender.__class__.__name__ == 'Company':
+            notice_sender = sender.admin_primary if sender.admin_primary else sender.created_by
+
+        renderer = MessageRenderer()
+        pairs = []
+        # activate each language once and render its recipients together
+        for language_code, group in self.partition_by_language(recipients, extra_context):
+            self.activate_language(language_code, extra_context)
+            for recipient in group:
+                if not recipient.is_active:
+                    continue
+                target_url = self.get_target_url(extra_context, sender, recipient)
+                text, subject, body = self.render_message(
+                    recipient, sender, notice_type, target_url, extra_context, renderer
+                )
+                notice = Notice(
+                    recipient=recipient,
+                    notice_type=notice_type,
+                    sender=notice_sender,
+                    message=text,
+                    target_url=target_url,
+                    on_site=False,
+                    site_id=settings.SITE_ID
+                )
+                message = EmailMessage(
+                    subject, body, settings.DEFAULT_FROM_EMAIL, [self.format_address(recipient)]
+                )
+                pairs.append((notice, message))
+        return pairs
+
+    def render_message(self, recipient, sender, notice_type, target_url, extra_context, renderer):
+        """
+        Returns the notice text, the email subject and the email body of a
+        notice to ``recipient``.
+        """
         context = self.default_context()
         context.update({
             "recipient": recipient,
@@ -61,58 +175,29 @@ class EmailBackend(backends.BaseBackend):
         })
         context.update(extra_context)
 
-        try:
-            messages = self.get_formatted_messages(("short.txt", "full.txt",), context['app_label'], context)
-        except:
-            messages = self.get_formatted_messages((
-                "short.txt",
-                "full.txt",
-            ), notice_type.label, context)
-
-        subject = "".join(render_to_string("notification/email_subject.txt", {
+        messages = self.get_formatted_messages((
+            "short.txt",
+            "full.txt",
+        ), self.get_labels(notice_type, context), context, renderer)
+
+        subject = "".join(renderer.render(("notification/email_subject.txt",), context, {
             "message": messages["short.txt"],
-        }, context).splitlines())
+        }).splitlines())
 
-        body = render_to_string("notification/email_body.txt", {
+        body = renderer.render(("notification/email_body.txt",), context, {
             "message": messages["full.txt"],
-        }, context)
-        recipients = ['"%s" <%s>' % (recipient.get_full_name(), recipient.email)]
-
-        if sender.__class__.__name__ == 'Company':
-            sender = sender.admin_primary if sender.admin_primary else sender.created_by
-
-        if recipient.is_active:
-            create_notice = False
-            if settings.PRODUCTION_SETTING:
-                try:
-                    notice_obj = Notice.objects.filter(
-                        recipient=recipient,
-                        notice_type=notice_type,
-                        sender=sender,
-                        target_url=target_url,
-                        on_site=False,
-                        site_id=settings.SITE_ID
-                    ).order_by('-added')[0]
-                except IndexError:
-                    notice_obj = None
-                    create_notice = True
-
-                if notice_obj and (timezone.now()-notice_obj.added).seconds/60 > settings.TIME_INTERVAL_BTW_TWO_NOTIFICATION:
-                    create_notice = True
-
-                if create_notice:
-                    Notice.objects.create(
-                        recipient=recipient,
-                        notice_type=notice_type,
-                        sender=sender,
-                        message=messages['full.txt'],
-                        target_url=target_url,
-                        on_site=False,
-                        site_id=settings.SITE_ID
-                    )
-                    send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, recipients)
-            else:
-                for admin in settings.ADMINS:
-                    user = User.objects.get(email=admin[1])
-                    recipients = ['"%s" <%s>' % (user.get_full_name(), user.email)]
-                    send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, recipients)
+        })
+        return messages["full.txt"], subject, body
+
+    def get_admins(self):
+        """
+        Returns the users among ``settings.ADMINS``, in that order.
+        """
+        admin_users = dict(
+            (user.email, user)
+            for user in User.objects.filter(email__in=[admin[1] for admin in settings.ADMINS])
+        )
+        return [admin_users[admin[1]] for admin in settings.ADMINS if admin[1] in admin_users]
+
+    def format_address(self, user):
+        return '"%s" <%s>' % (user.get_full_name(), user.email)
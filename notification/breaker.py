@@ -0,0 +1,195 @@
+"""
+Circuit breakers guarding the notification backends.
+
+Every delivery a backend makes is recorded in its breaker, with whether it
+raised and how long it took per recipient. When too many of the deliveries
+within ``NOTIFICATION_BREAKER_WINDOW`` seconds failed or were slow the
+breaker opens: ``fan_out`` stops calling the backend and queues its
+recipients again instead, while the other backends deliver as usual. After
+``NOTIFICATION_BREAKER_OPEN_SECONDS`` a single delivery is let through as a
+probe, which closes the breaker again when it succeeds.
+
+Breakers live in each process. Every change of state is logged, sent as the
+``breaker_state_changed`` signal and stored in the cache, where
+``get_published_states`` reads the latest state of every backend, whichever
+process it was reported by.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+
+from notification.signals import breaker_state_changed
+
+
+# seconds of deliveries the error rate and latency are measured over
+WINDOW = getattr(settings, "NOTIFICATION_BREAKER_WINDOW", 60)
+# share of failed or slow deliveries within the window which opens a breaker
+FAILURE_RATE = getattr(settings, "NOTIFICATION_BREAKER_FAILURE_RATE", 0.5)
+# seconds per recipient above which a delivery counts as slow
+SLOW_DELIVERY = getattr(settings, "NOTIFICATION_BREAKER_SLOW_DELIVERY", 2.0)
+# deliveries needed within the window before a breaker may open
+MIN_DELIVERIES = getattr(settings, "NOTIFICATION_BREAKER_MIN_DELIVERIES", 5)
+# seconds an open breaker waits before letting a probe through
+OPEN_SECONDS = getattr(settings, "NOTIFICATION_BREAKER_OPEN_SECONDS", 60)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+CACHE_KEY = "notification:breaker:%s"
+LABELS_CACHE_KEY = "notification:breakers"
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, window=None, failure_rate=None, slow_delivery=None,
+                 min_deliveries=None, open_seconds=None):
+        self.name = name
+        self.window = WINDOW if window is None else window
+        self.failure_rate = FAILURE_RATE if failure_rate is None else failure_rate
+        self.slow_delivery = SLOW_DELIVERY if slow_delivery is None else slow_delivery
+        self.min_deliveries = MIN_DELIVERIES if min_deliveries is None else min_deliveries
+        self.open_seconds = OPEN_SECONDS if open_seconds is None else open_seconds
+        self.state = CLOSED
+        self.opened = None
+        self.probing = False
+        # (time, failed, seconds per recipient) of the deliveries in the window
+        self.deliveries = deque()
+        # reentrant, receivers of breaker_state_changed may ask for a snapshot
+        self._lock = threading.RLock()
+
+    def allow(self, now=None):
+        """
+        Returns whether the backend may be called. An open breaker lets one
+        probe through once it has been open for ``open_seconds``.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if self.state == OPEN and now - self.opened >= self.open_seconds:
+                self._change(HALF_OPEN, now)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == CLOSED
+
+    def record(self, ok, seconds, recipients=1, now=None):
+        """
+        Records a delivery to ``recipients`` users which took ``seconds`` and
+        raised unless ``ok``.
+        """
+        now = time.time() if now is None else now
+        latency = seconds / max(recipients, 1)
+        failed = not ok or latency > self.slow_delivery
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+                self.deliveries.clear()
+                self._change(OPEN if failed else CLOSED, now)
+                return
+            self.deliveries.append((now, failed, latency))
+            self._expire(now)
+            if self.state == CLOSED and len(self.deliveries) >= self.min_deliveries and \
+                    self._failure_rate() >= self.failure_rate:
+                self._change(OPEN, now)
+
+    def snapshot(self, now=None):
+        """
+        Returns the state of the breaker and the figures it is based on.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._expire(now)
+            return self._snapshot(now)
+
+    def _expire(self, now):
+        while self.deliveries and self.deliveries[0][0] < now - self.window:
+            self.deliveries.popleft()
+
+    def _failure_rate(self):
+        if not self.deliveries:
+            return 0.0
+        return float(sum(1 for _, failed, _ in self.deliveries if failed)) / len(self.deliveries)
+
+    def _snapshot(self, now):
+        latencies = [latency for _, _, latency in self.deliveries]
+        return {
+            "backend": self.name,
+            "state": self.state,
+            "opened": self.opened,
+            "deliveries": len(self.deliveries),
+            "failure_rate": self._failure_rate(),
+            "latency": sum(latencies) / len(latencies) if latencies else None,
+            "updated": now,
+        }
+
+    def _change(self, state, now):
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self.opened = now
+            logging.warning(
+                "notification backend {} is unhealthy, circuit breaker opened".format(self.name)
+            )
+        else:
+            if state == CLOSED:
+                self.opened = None
+            logging.info("notification backend {} circuit breaker is {}".format(self.name, state))
+        publish(self._snapshot(now))
+        breaker_state_changed.send(
+            sender=CircuitBreaker, backend=self.name, state=state, previous=previous
+        )
+
+
+def get_breaker(name):
+    """
+    Returns this process's breaker for the backend labelled ``name``.
+    """
+    try:
+        return _breakers[name]
+    except KeyError:
+        with _breakers_lock:
+            return _breakers.setdefault(name, CircuitBreaker(name))
+
+
+def get_states():
+    """
+    Returns a snapshot of every breaker of this process, keyed by backend.
+    """
+    return dict((name, breaker.snapshot()) for name, breaker in list(_breakers.items()))
+
+
+def publish(snapshot):
+    try:
+        labels = cache.get(LABELS_CACHE_KEY) or []
+        if snapshot["backend"] not in labels:
+            cache.set(LABELS_CACHE_KEY, labels + [snapshot["backend"]], None)
+        cache.set(CACHE_KEY % snapshot["backend"], snapshot, None)
+    except Exception:  # pylint: disable-msg=W0703
+        # monitoring must never break delivery
+        logging.exception("could not publish circuit breaker state")
+
+
+def get_published_states():
+    """
+    Returns the last state published for every backend, keyed by backend,
+    as reported by any process.
+    """
+    labels = cache.get(LABELS_CACHE_KEY) or []
+    states = cache.get_many([CACHE_KEY % label for label in labels])
+    return dict((state["backend"], state) for state in states.values())
+
+
+def reset():
+    """
+    Forgets every breaker of this process, closing them.
+    """
+    with _breakers_lock:
+        _breakers.clear()
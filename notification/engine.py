@@ -1,96 +1,527 @@
+import os
 import sys
 import time
+import datetime
+import signal
+import socket
+import threading
+import multiprocessing
 import logging
 import traceback
-import base64
 
 from django.conf import settings
 from django.core.mail import mail_admins
-from django.contrib.auth.models import User
+from django.db import connections
 from django.contrib.sites.models import Site
-from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
+from django.utils import six
+from django.utils import timezone
+from django.utils.six.moves import queue
 
-from notification.lockfile import FileLock, AlreadyLocked, LockTimeout
+from notification.audiences import BaseAudience
 from notification.models import NoticeQueueBatch
+from notification.payload import encode_payload, load_batch, resolve_references
 from notification.signals import emitted_notices
+from notification import backends
+from notification import breaker
+from notification import wakeup
+from notification.utils import chunks
 from notification import models as notification
 
-# lock timeout value. how long to wait for the lock to become available.
-# default behavior is to never wait for the lock to be available.
-LOCK_WAIT_TIMEOUT = getattr(settings, "NOTIFICATION_LOCK_WAIT_TIMEOUT", -1)
+# number of queued batches loaded from the database at a time
+QUEUE_CHUNK_SIZE = getattr(settings, "NOTIFICATION_QUEUE_CHUNK_SIZE", 100)
 
+# number of recipients a batch being sent records progress after, so a batch
+# interrupted by a crash resumes there instead of starting over
+CHECKPOINT_INTERVAL = getattr(settings, "NOTIFICATION_CHECKPOINT_INTERVAL", 500)
+
+# when delivering to a chunk failed and delivering to each of this many of its
+# recipients separately fails as well, the whole batch is failed
+ISOLATION_ATTEMPTS = 3
+
+# bounds, in seconds, of the interval at which an idle daemon polls the queue;
+# it doubles from the lower to the upper bound while the queue stays empty
+DAEMON_POLL_MIN = getattr(settings, "NOTIFICATION_DAEMON_POLL_MIN", 1)
+DAEMON_POLL_MAX = getattr(settings, "NOTIFICATION_DAEMON_POLL_MAX", 30)
+
+
+def default_worker_id():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
 
-def acquire_lock(*args):
-    if len(args) == 1:
-        lock = FileLock(args[0])
-    else:
-        lock = FileLock("send_notices")
 
-    logging.debug("acquiring lock...")
+def iter_batches(worker, chunk_size=None):
+    """
+    Claims queued batches for ``worker``, oldest first and ``chunk_size`` at a
+    time, and yields ``(queued_batch, notices)`` tuples, ``notices`` as
+    returned by ``load_batch`` or None if loading failed. The model
+    references of a whole chunk are resolved together.
+
+    The leases on a chunk are renewed once half of their lifetime has passed;
+    batches whose lease was lost in the meantime are skipped as another
+    worker may have taken them over.
+    """
+    chunk_size = chunk_size or QUEUE_CHUNK_SIZE
+    while True:
+        chunk = NoticeQueueBatch.objects.claim(worker, chunk_size)
+        if not chunk:
+            return
+        loaded = load_chunk(chunk)
+        held = set(queued_batch.pk for queued_batch in chunk)
+        renewed = time.time()
+        for i, queued_batch in enumerate(chunk):
+            if time.time() - renewed > notification.QUEUE_LEASE_SECONDS / 2.0:
+                held = NoticeQueueBatch.objects.extend(worker, [batch.pk for batch in chunk[i:]])
+                renewed = time.time()
+            if queued_batch.pk in held:
+                yield queued_batch, loaded[i]
+
+
+def load_chunk(chunk):
+    """
+    Returns the notices of each queued batch in ``chunk``, as returned by
+    ``load_batch`` with the references of all of them resolved together, or
+    None for those that could not be loaded.
+    """
+    loaded = []
+    for queued_batch in chunk:
+        try:
+            loaded.append(load_batch(queued_batch))
+        except Exception:  # pylint: disable-msg=W0703
+            # loaded again and failed by send_batch
+            loaded.append(None)
     try:
-        lock.acquire(LOCK_WAIT_TIMEOUT)
-    except AlreadyLocked:
-        logging.debug("lock already in place. quitting.")
-        return
-    except LockTimeout:
-        logging.debug("waiting for the lock timed out. quitting.")
-        return
-    logging.debug("acquired.")
-    return lock
+        resolved = iter(resolve_references([
+            notice for notices in loaded if notices is not None for notice in notices
+        ]))
+        return [
+            None if notices is None else [next(resolved) for notice in notices]
+            for notices in loaded
+        ]
+    except Exception:  # pylint: disable-msg=W0703
+        # resolved batch by batch by send_batch instead, so the failure
+        # is traced to its batch
+        return [None] * len(chunk)
 
 
-def send_all(*args):
-    lock = acquire_lock(*args)
-    batches, sent, sent_actual = 0, 0, 0
-    start_time = time.time()
+def recipient_chunks(user_ids, start=None):
+    """
+    Splits the recipients of a queued notice, a list of primary keys or an
+    audience, into lists of primary keys of manageable size, starting at the
+    checkpoint position ``start``. Yields ``(chunk, position)`` tuples with
+    the position to checkpoint once the chunk was sent.
+    """
+    size = notification.BULK_QUERY_SIZE
+    if CHECKPOINT_INTERVAL:
+        size = min(size, CHECKPOINT_INTERVAL)
+    if isinstance(user_ids, BaseAudience):
+        for chunk in user_ids.iter_chunks(size, after=start):
+            yield chunk, chunk[-1]
+    else:
+        offset = start or 0
+        for chunk in chunks(user_ids[offset:], size):
+            offset += len(chunk)
+            yield chunk, offset
 
+
+def send_chunk(user_ids, label, extra_context, sender, counts, attempts=1):
+    """
+    Delivers a notice to the users ``user_ids`` and adds to the ``sent`` and
+    ``sent_actual`` totals in ``counts``. ``attempts`` is the number of
+    attempts the queued batch they came from has been given.
+    """
+    # load every recipient of the chunk at once
+    users = notification.load_recipients(user_ids)
     try:
-        # nesting the try statement to be Python 2.4
-        try:
-            for queued_batch in NoticeQueueBatch.objects.all():
-                notices = pickle.loads(base64.b64decode(queued_batch.pickled_data))
-                for user, label, extra_context, sender in notices:
-                    try:
-                        user = User.objects.get(pk=user)
-                        logging.info("emitting notice {} to {}".format(label, user))
-                        # call this once per user to be atomic and allow for logging to
-                        # accurately show how long each takes.
-                        if notification.send_now([user], label, extra_context, sender):
-                            sent_actual += 1
-                    except User.DoesNotExist:
-                        # Ignore deleted users, just warn about them
-                        logging.warning(
-                            "not emitting notice {} to user {} since it does not exist".format(
-                                label,
-                                user)
-                        )
-                    sent += 1
-                queued_batch.delete()
-                batches += 1
-            emitted_notices.send(
-                sender=NoticeQueueBatch,
-                batches=batches,
-                sent=sent,
-                sent_actual=sent_actual,
-                run_time="%.2f seconds" % (time.time() - start_time)
+        # warm the language cache for the whole chunk at once
+        notification.get_notification_languages(list(users))
+    except notification.LanguageStoreNotAvailable:
+        pass
+    recipients = []
+    for user_id in user_ids:
+        if user_id in users:
+            recipients.append(users[user_id])
+        else:
+            # Ignore deleted users, just warn about them
+            logging.warning(
+                "not emitting notice {} to user {} since it does not exist".format(
+                    label,
+                    user_id)
             )
+    if recipients:
+        logging.info("emitting notice {} to {} users".format(label, len(recipients)))
+        try:
+            # deliver the whole chunk at once so it goes through the
+            # bulk preference, rendering and insert paths
+            delivered = notification.fan_out(recipients, label, extra_context, sender)
         except Exception:  # pylint: disable-msg=W0703
-            # get the exception
-            _, e, _ = sys.exc_info()
-            # email people
-            current_site = Site.objects.get_current()
-            subject = "[{} emit_notices] {}".format(current_site.name, e)
-            message = "\n".join(
-                traceback.format_exception(*sys.exc_info())  # pylint: disable-msg=W0142
+            if len(recipients) == 1:
+                raise
+            delivered = deliver_separately(
+                recipients, label, extra_context, sender, counts, attempts
             )
-            mail_admins(subject, message, fail_silently=True)
-            # log it as critical
-            logging.critical("an exception occurred: {}".format(e))
+        counts["sent_actual"] += len(delivered)
+    counts["sent"] += len(user_ids)
+
+
+def deliver_separately(recipients, label, extra_context, sender, counts, attempts=1):
+    """
+    Delivers a notice to ``recipients`` one at a time after delivering to
+    all of them at once failed, and returns the primary keys of those it was
+    delivered to. The recipients it fails for are queued again as a batch of
+    their own, which keeps the ``attempts`` of the batch they came from so
+    they are moved to the dead letters like it would be. When it fails for
+    every recipient, or each of the first few, the problem is not with
+    particular recipients, and the original exception is raised again to
+    fail the whole batch.
+    """
+    exc_info = sys.exc_info()
+    logging.warning("delivering notice {} to {} users failed, trying them one by one".format(
+        label, len(recipients)
+    ))
+    delivered, failed, error = set(), [], None
+    for tried, user in enumerate(recipients, 1):
+        try:
+            delivered.update(notification.fan_out([user], label, extra_context, sender))
+        except Exception:  # pylint: disable-msg=W0703
+            failed.append(user.pk)
+            error = traceback.format_exc()
+            # every recipient tried so far failed
+            if len(failed) == tried and (tried == len(recipients) or tried >= ISOLATION_ATTEMPTS):
+                six.reraise(*exc_info)
+    if failed:
+        logging.error("delivering notice {} failed for users {}, queued again:\n{}".format(
+            label, failed, error
+        ))
+        counts["failed"] += len(failed)
+        NoticeQueueBatch.objects.create(
+            payload=encode_payload(failed, label, extra_context, sender),
+            attempts=attempts,
+            next_attempt=timezone.now() + datetime.timedelta(
+                seconds=notification.QUEUE_RETRY_DELAY
+            ),
+            last_error=error,
+        )
+    return delivered
+
+
+def split_batch(queued_batch, groups):
+    """
+    Replaces a queued batch sending a notice to a whole audience by batches
+    for consecutive ranges of at most ``NOTIFICATION_QUEUE_BATCH_SIZE`` of
+    its recipients, so several workers can share them. Returns whether the
+    batch was replaced; small audiences, ranges of an audience and batches
+    already being sent are left as they are.
+    """
+    if len(groups) != 1 or queued_batch.progress:
+        return False
+    user_ids, label, extra_context, sender = groups[0]
+    if not isinstance(user_ids, BaseAudience) or user_ids.is_split():
+        return False
+    shards = user_ids.split(notification.QUEUE_BATCH_SIZE)
+    if len(shards) < 2:
+        return False
+    logging.info("splitting batch {} into {} batches".format(queued_batch.pk, len(shards)))
+    if not queued_batch.replace([
+        encode_payload(shard, label, extra_context, sender) for shard in shards
+    ]):
+        logging.warning("lost the lease on batch {}, leaving it to its new worker".format(
+            queued_batch.pk
+        ))
+    return True
+
+
+def send_batch(queued_batch, counts, groups=None):
+    """
+    Sends the notices of one queued batch and adds to the ``batches``,
+    ``sent`` and ``sent_actual`` totals in ``counts``. ``groups`` are the
+    batch's notices if they were loaded already.
+    """
+    if groups is None:
+        groups = resolve_references(load_batch(queued_batch))
+    if split_batch(queued_batch, groups):
+        return
+    # resume after the last checkpoint of an earlier attempt
+    resume_index, resume_position = queued_batch.get_progress()
+    pending = 0
+    for index, (user_ids, label, extra_context, sender) in enumerate(groups):
+        if index < resume_index:
+            continue
+        start = resume_position if index == resume_index else None
+        for chunk, position in recipient_chunks(user_ids, start):
+            send_chunk(chunk, label, extra_context, sender, counts, queued_batch.attempts)
+            pending += len(chunk)
+            if CHECKPOINT_INTERVAL and pending >= CHECKPOINT_INTERVAL:
+                pending = 0
+                if not queued_batch.checkpoint(index, position):
+                    logging.warning(
+                        "lost the lease on batch {}, leaving it to its new worker".format(
+                            queued_batch.pk
+                        )
+                    )
+                    return
+    queued_batch.delete()
+    counts["batches"] += 1
+
+
+def send_batches(worker, counts, chunk_size=None, stop=None):
+    """
+    Claims and sends queued batches as ``worker`` until the queue is empty or
+    the ``stop`` event is set, adding to the totals in ``counts``.
+    """
+    try:
+        # keep backend connections (e.g. SMTP) open across all batches
+        with backends.opened(notification.NOTIFICATION_BACKENDS.values()):
+            for queued_batch, groups in iter_batches(worker, chunk_size):
+                try:
+                    send_batch(queued_batch, counts, groups)
+                except Exception:  # pylint: disable-msg=W0703
+                    fail_batch(queued_batch, counts)
+                if stop is not None and stop.is_set():
+                    break
     finally:
-        logging.debug("releasing lock...")
-        lock.release()
-        logging.debug("released.")
+        # hand batches this worker did not get to back to the others
+        NoticeQueueBatch.objects.release(worker)
+
+
+def fail_batch(queued_batch, counts):
+    """
+    Handles the exception raised while sending ``queued_batch``: the batch
+    is retried later or, once it failed too often, moved to the dead letters
+    and the admins are told.
+    """
+    error = traceback.format_exc()
+    logging.error("sending batch {} failed on attempt {}:\n{}".format(
+        queued_batch.pk, queued_batch.attempts, error
+    ))
+    counts["failed"] += 1
+    if queued_batch.fail(error) is not None:
+        logging.error("batch {} moved to the dead letters".format(queued_batch.pk))
+        report_exception()
+
+
+def report_exception():
+    # get the exception
+    _, e, _ = sys.exc_info()
+    # email people
+    current_site = Site.objects.get_current()
+    subject = "[{} emit_notices] {}".format(current_site.name, e)
+    message = "\n".join(
+        traceback.format_exception(*sys.exc_info())  # pylint: disable-msg=W0142
+    )
+    mail_admins(subject, message, fail_silently=True)
+    # log it as critical
+    logging.critical("an exception occurred: {}".format(e))
+
 
+def new_counts():
+    return {"batches": 0, "sent": 0, "sent_actual": 0, "failed": 0}
+
+
+def emitted(counts, start_time):
+    emitted_notices.send(
+        sender=NoticeQueueBatch,
+        batches=counts["batches"],
+        sent=counts["sent"],
+        sent_actual=counts["sent_actual"],
+        run_time="%.2f seconds" % (time.time() - start_time)
+    )
+
+
+def log_summary(counts, start_time):
     logging.info("")
-    logging.info("{} batches, {} sent".format(batches, sent,))
+    logging.info("{} batches, {} sent, {} failed".format(
+        counts["batches"], counts["sent"], counts["failed"]
+    ))
+    for name, state in sorted(breaker.get_states().items()):
+        if state["state"] != breaker.CLOSED:
+            logging.warning("circuit breaker of backend {} is {}".format(name, state["state"]))
     logging.info("done in {:.2f} seconds".format(time.time() - start_time))
+
+
+def send_all(*args, **kwargs):
+    """
+    Sends queued notices. Any number of workers may run this at once, on one
+    host or many: each claims disjoint batches with a lease, see
+    ``NoticeQueueBatch.objects.claim``. Positional arguments are accepted for
+    backwards compatibility and ignored.
+    """
+    chunk_size = kwargs.get("chunk_size")
+    worker = kwargs.get("worker") or default_worker_id()
+    counts = new_counts()
+    start_time = time.time()
+
+    try:
+        send_batches(worker, counts, chunk_size)
+        emitted(counts, start_time)
+    except Exception:  # pylint: disable-msg=W0703
+        report_exception()
+
+    log_summary(counts, start_time)
+    return counts
+
+
+def close_connections():
+    for conn in connections.all():
+        conn.close()
+
+
+def _run_worker(stop, results, chunk_size):
+    counts, failed = new_counts(), False
+    try:
+        send_batches(default_worker_id(), counts, chunk_size, stop)
+    except Exception:  # pylint: disable-msg=W0703
+        report_exception()
+        failed = True
+    finally:
+        close_connections()
+    results.put((counts, failed))
+
+
+def send_all_parallel(workers, chunk_size=None):
+    """
+    Sends queued notices from ``workers`` child processes, each with its own
+    database connection and claiming its own batches. The totals are
+    combined into one ``emitted_notices`` signal. On SIGTERM the children
+    finish the batch at hand and exit.
+    """
+    counts = new_counts()
+    start_time = time.time()
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    # children must not share the parent's database connections
+    close_connections()
+    # installed before forking so the children inherit it
+    previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    processes = [
+        multiprocessing.Process(target=_run_worker, args=(stop, results, chunk_size))
+        for i in range(workers)
+    ]
+    failed = False
+    try:
+        for process in processes:
+            process.start()
+        reports = 0
+        while reports < workers:
+            try:
+                worker_counts, worker_failed = results.get(timeout=1)
+            except (queue.Empty, IOError):
+                # IOError: the wait was interrupted by SIGTERM
+                if not any(process.is_alive() for process in processes) and results.empty():
+                    # a child died without reporting
+                    failed = True
+                    break
+                continue
+            reports += 1
+            failed = failed or worker_failed
+            for key in counts:
+                counts[key] += worker_counts[key]
+        for process in processes:
+            process.join()
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+    if not failed:
+        emitted(counts, start_time)
+    log_summary(counts, start_time)
+    return counts
+
+
+class _DaemonLimits(object):
+    """
+    Tells ``send_batches`` when a daemon has to stop: on a signal or once it
+    ran for ``max_runtime`` seconds or sent ``max_batches`` batches.
+    """
+    def __init__(self, stop, totals, max_runtime=None, max_batches=None):
+        self.stop = stop
+        self.totals = totals
+        self.deadline = time.time() + max_runtime if max_runtime else None
+        self.max_batches = max_batches
+        self.current = new_counts()
+
+    def remaining_time(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def is_set(self):
+        if self.stop.is_set():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        batches = self.totals["batches"] + self.current["batches"]
+        return bool(self.max_batches) and batches >= self.max_batches
+
+
+def run_daemon(chunk_size=None, max_runtime=None, max_batches=None):
+    """
+    Keeps sending queued notices from a warm process. While the queue is
+    empty it is polled with exponential backoff between DAEMON_POLL_MIN and
+    DAEMON_POLL_MAX seconds, waking up at once when NOTIFICATION_WAKEUP_ADDRESS
+    is set and ``queue`` stores new batches.
+
+    SIGTERM and SIGINT drain the daemon: the batch at hand is finished, the
+    remaining leases are released and it returns. So does reaching
+    ``max_runtime`` seconds or ``max_batches`` batches, to recycle the process.
+    """
+    worker = default_worker_id()
+    totals = new_counts()
+    start_time = time.time()
+    stop = threading.Event()
+    limits = _DaemonLimits(stop, totals, max_runtime, max_batches)
+    previous_handlers = dict(
+        (signum, signal.signal(signum, lambda signum, frame: stop.set()))
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    )
+    listener = wakeup.Listener() if wakeup.WAKEUP_ADDRESS else None
+    interval = DAEMON_POLL_MIN
+    try:
+        while not limits.is_set():
+            limits.current = counts = new_counts()
+            pass_start = time.time()
+            failed = False
+            try:
+                send_batches(worker, counts, chunk_size, limits)
+            except Exception:  # pylint: disable-msg=W0703
+                report_exception()
+                failed = True
+            for key in totals:
+                totals[key] += counts[key]
+            if counts["batches"] and not failed:
+                emitted(counts, pass_start)
+                interval = DAEMON_POLL_MIN
+                continue
+            if limits.is_set():
+                break
+            # idle: let the database drop the connection rather than time it out
+            close_connections()
+            timeout = interval
+            if limits.remaining_time() is not None:
+                timeout = min(timeout, limits.remaining_time())
+            if _wait(listener, stop, timeout):
+                interval = DAEMON_POLL_MIN
+            else:
+                interval = min(interval * 2, DAEMON_POLL_MAX)
+    finally:
+        if listener is not None:
+            listener.close()
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    log_summary(totals, start_time)
+    return totals
+
+
+def _wait(listener, stop, timeout):
+    """
+    Sleeps up to ``timeout`` seconds and returns whether a wake-up arrived,
+    checking ``stop`` at least every second.
+    """
+    deadline = time.time() + timeout
+    while not stop.is_set():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        if listener is None:
+            stop.wait(min(remaining, 1))
+        elif listener.wait(min(remaining, 1)):
+            return True
+    return False
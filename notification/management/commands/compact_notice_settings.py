@@ -0,0 +1,61 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from notification.models import NoticeSetting, NoticeType
+
+
+class Command(BaseCommand):
+    help = "Delete notice settings which only repeat the default."
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size", type="int", dest="chunk_size", default=1000,
+                    help="Number of settings examined per query."),
+        make_option("--force", action="store_true", dest="force", default=False,
+                    help="Compact even if NOTIFICATION_SPARSE_SETTINGS is off."),
+    )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        if not (NoticeSetting.is_sparse() or options["force"]):
+            raise CommandError(
+                "NOTIFICATION_SPARSE_SETTINGS is off, deleted settings would "
+                "be written again on the next read. Use --force to compact anyway."
+            )
+        chunk_size = options["chunk_size"]
+        notice_types = dict((nt.pk, nt) for nt in NoticeType.objects.all())
+
+        examined = deleted = 0
+        last_pk = 0
+        while True:
+            # walk the table in primary key order so every query is bounded
+            rows = list(NoticeSetting.objects.filter(
+                pk__gt=last_pk
+            ).order_by("pk").values_list("pk", "notice_type", "medium", "send")[:chunk_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            redundant = {}
+            for pk, notice_type_id, medium, send in rows:
+                if send == NoticeSetting.get_default(notice_types[notice_type_id], medium):
+                    redundant.setdefault(send, []).append(pk)
+            for send, pks in redundant.items():
+                deleted += self.delete_unchanged(pks, send)
+            examined += len(rows)
+            logging.debug("examined %s settings, deleted %s" % (examined, deleted))
+        logging.info("deleted %s of %s notice settings" % (deleted, examined))
+
+    def delete_unchanged(self, pks, send):
+        """
+        Deletes the settings ``pks`` which still have the value ``send`` and
+        returns how many there were. A setting changed since it was read is
+        a new override and kept.
+        """
+        with transaction.atomic():
+            # lock the rows so a concurrent change waits for the delete
+            unchanged = list(NoticeSetting.objects.select_for_update().filter(
+                pk__in=pks, send=send
+            ).values_list("pk", flat=True))
+            NoticeSetting.objects.filter(pk__in=unchanged).delete()
+        return len(unchanged)
@@ -1,14 +1,42 @@
 import logging
+from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from notification.engine import send_all
+from notification.engine import send_all, send_all_parallel, run_daemon
 
 
 class Command(BaseCommand):
     help = "Emit queued notices."
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size", type="int", dest="chunk_size", default=None,
+                    help="Number of queued batches loaded at a time."),
+        make_option("--workers", type="int", dest="workers", default=1,
+                    help="Number of worker processes sending notices."),
+        make_option("--daemon", action="store_true", dest="daemon", default=False,
+                    help="Keep running and send notices as they are queued."),
+        make_option("--max-runtime", type="int", dest="max_runtime", default=None,
+                    help="With --daemon, exit after this many seconds."),
+        make_option("--max-batches", type="int", dest="max_batches", default=None,
+                    help="With --daemon, exit after sending this many batches."),
+    )
 
     def handle(self, *args, **options):
+        if options["daemon"] and options["workers"] > 1:
+            raise CommandError(
+                "--daemon and --workers cannot be combined, run several daemons instead."
+            )
+        if not options["daemon"] and (options["max_runtime"] or options["max_batches"]):
+            raise CommandError("--max-runtime and --max-batches require --daemon.")
         logging.basicConfig(level=logging.DEBUG, format="%(message)s")
         logging.info("-" * 72)
-        send_all(*args)
+        if options["daemon"]:
+            run_daemon(
+                chunk_size=options["chunk_size"],
+                max_runtime=options["max_runtime"],
+                max_batches=options["max_batches"],
+            )
+        elif options["workers"] > 1:
+            send_all_parallel(options["workers"], chunk_size=options["chunk_size"])
+        else:
+            send_all(*args, chunk_size=options["chunk_size"])
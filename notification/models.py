@@ -1,22 +1,34 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
-import base64
+import calendar
+from collections import OrderedDict
 import datetime
+import hashlib
+import json
+import logging
+import time
 
-from django.db import models
+from django.db import connections, models, transaction
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import get_language, activate
-from django.utils.encoding import python_2_unicode_compatible
-from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
+from django.utils.encoding import python_2_unicode_compatible, force_bytes, force_text
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
 
+from .audiences import BaseAudience, QueryAudience
+from .breaker import CLOSED, get_breaker
 from .compat import AUTH_USER_MODEL
+from .signals import notices_queued
+from .utils import bulk_insert_ignore, chunks
 
 from notification import backends
 
@@ -27,6 +39,28 @@ NOTIFICATION_BACKENDS = backends.load_backends()
 NOTICE_MEDIA, NOTICE_MEDIA_DEFAULTS = backends.load_media_defaults(
     backends=NOTIFICATION_BACKENDS
 )
+# language notices are rendered in for users without a stored language
+DEFAULT_LANGUAGE = getattr(settings, "NOTIFICATION_DEFAULT_LANGUAGE", "en")
+# upper bound on the number of ids passed to a single ``__in`` lookup
+BULK_QUERY_SIZE = getattr(settings, "NOTIFICATION_BULK_QUERY_SIZE", 500)
+# how often, in seconds, the notice type registry checks the cache framework
+# for changes made by other processes
+NOTICE_TYPE_CHECK_INTERVAL = getattr(settings, "NOTIFICATION_NOTICE_TYPE_CHECK_INTERVAL", 5)
+# the registry is reloaded at least this often, in seconds, even without a
+# cache shared between processes
+NOTICE_TYPE_MAX_AGE = getattr(settings, "NOTIFICATION_NOTICE_TYPE_MAX_AGE", 300)
+NOTICE_TYPE_VERSION_KEY = "notification:notice_types:version"
+# queue QuerySets of recipients as their query rather than their primary keys
+LAZY_QUERYSETS = getattr(settings, "NOTIFICATION_QUEUE_LAZY_QUERYSETS", True)
+# maximum number of recipients stored in one queued batch
+QUEUE_BATCH_SIZE = getattr(settings, "NOTIFICATION_QUEUE_BATCH_SIZE", 1000)
+# number of failed attempts after which a batch is moved to the dead letters
+QUEUE_MAX_ATTEMPTS = getattr(settings, "NOTIFICATION_QUEUE_MAX_ATTEMPTS", 5)
+# seconds before a failed batch is retried, doubled for every further attempt
+QUEUE_RETRY_DELAY = getattr(settings, "NOTIFICATION_QUEUE_RETRY_DELAY", 60)
+# how long, in seconds, a worker holds the queued batches it claimed before
+# other workers may take them over
+QUEUE_LEASE_SECONDS = getattr(settings, "NOTIFICATION_QUEUE_LEASE_SECONDS", 300)
 STATE_TYPES = (
     (-1, _('Deleted')),
     (0, _('Draft')),
@@ -38,8 +72,83 @@ class LanguageStoreNotAvailable(Exception):
     pass
 
 
-def create_notice_type(label, display, description, **kwargs):
-    NoticeType.create(label, display, description, **kwargs)
+def create_notice_type(label, display, past_tense, description, **kwargs):
+    NoticeType.create(label, display, past_tense, description, **kwargs)
+
+
+class NoticeTypeManager(models.Manager):
+    """
+    Keeps a process-local label -> NoticeType registry which is loaded
+    lazily in one query and reused until a NoticeType is saved or deleted
+    (in any process sharing the cache framework) or it gets too old.
+    """
+
+    def __init__(self):
+        super(NoticeTypeManager, self).__init__()
+        self._registry = None
+        self._version = None
+        self._loaded = self._checked = 0
+
+    def _get_registry(self):
+        # the manager is shared between threads, any of which may drop the
+        # registry at any time, so only the local reference is relied upon
+        now = time.time()
+        registry = self._registry
+        if registry is not None:
+            if now - self._loaded >= NOTICE_TYPE_MAX_AGE:
+                registry = None
+            elif now - self._checked >= NOTICE_TYPE_CHECK_INTERVAL:
+                self._checked = now
+                if cache.get(NOTICE_TYPE_VERSION_KEY) != self._version:
+                    registry = None
+        if registry is None:
+            version = cache.get(NOTICE_TYPE_VERSION_KEY)
+            registry = OrderedDict(
+                (notice_type.label, notice_type) for notice_type in self.all()
+            )
+            self._registry, self._version = registry, version
+            self._loaded = self._checked = now
+        return registry
+
+    def get_cached(self, label):
+        """
+        Returns the NoticeType with the given label from the registry.
+        """
+        registry = self._get_registry()
+        if label not in registry:
+            # it may have been created since the registry was loaded
+            self.clear_cache()
+            registry = self._get_registry()
+        try:
+            return registry[label]
+        except KeyError:
+            raise self.model.DoesNotExist("NoticeType matching label %r does not exist." % label)
+
+    def all_cached(self):
+        """
+        Returns a list of all NoticeTypes from the registry.
+        """
+        return list(self._get_registry().values())
+
+    def clear_cache(self, broadcast=False):
+        """
+        Drops the registry of this process. With ``broadcast``, other
+        processes sharing the cache framework drop theirs too.
+        """
+        if broadcast:
+            try:
+                cache.incr(NOTICE_TYPE_VERSION_KEY)
+            except ValueError:
+                cache.set(NOTICE_TYPE_VERSION_KEY, 1, None)
+        self._registry = None
+
+    def get_version(self):
+        """
+        Returns the version of the registry currently in use, which changes
+        whenever a NoticeType is saved or deleted.
+        """
+        self._get_registry()
+        return self._version
 
 
 @python_2_unicode_compatible
@@ -55,6 +164,8 @@ class NoticeType(models.Model):
 
     state = models.SmallIntegerField(verbose_name=_('Publish state'), choices=STATE_TYPES, default=1)
 
+    objects = NoticeTypeManager()
+
     def __str__(self):
         return self.label
 
@@ -94,6 +205,12 @@ class NoticeType(models.Model):
                 print("Created %s NoticeType" % label)
 
 
+@receiver(post_save, sender=NoticeType)
+@receiver(post_delete, sender=NoticeType)
+def clear_notice_type_cache(sender, **kwargs):
+    NoticeType.objects.clear_cache(broadcast=True)
+
+
 class NoticeSetting(models.Model):
     """
     Indicates, for a given user, whether to send notifications
@@ -110,15 +227,107 @@ class NoticeSetting(models.Model):
         verbose_name_plural = _("notice settings")
         unique_together = ("user", "notice_type", "medium")
 
+    @staticmethod
+    def is_sparse():
+        """
+        Whether only settings differing from the default are stored, see the
+        NOTIFICATION_SPARSE_SETTINGS setting.
+        """
+        return getattr(settings, "NOTIFICATION_SPARSE_SETTINGS", False)
+
+    @staticmethod
+    def get_default(notice_type, medium):
+        return (NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default)
+
     @classmethod
     def for_user(cls, user, notice_type, medium):
-        try:
-            return cls._default_manager.get(user=user, notice_type=notice_type, medium=medium)
-        except cls.DoesNotExist:
-            default = (NOTICE_MEDIA_DEFAULTS[medium] <= notice_type.default)
-            setting = cls(user=user, notice_type=notice_type, medium=medium, send=default)
-            setting.save()
-            return setting
+        default = cls.get_default(notice_type, medium)
+        if cls.is_sparse():
+            try:
+                return cls._default_manager.get(user=user, notice_type=notice_type, medium=medium)
+            except cls.DoesNotExist:
+                return cls(user=user, notice_type=notice_type, medium=medium, send=default)
+        # get_or_create falls back to reading the row when a concurrent
+        # writer inserted it first
+        setting, created = cls._default_manager.get_or_create(
+            user=user, notice_type=notice_type, medium=medium, defaults={"send": default}
+        )
+        return setting
+
+    @classmethod
+    def for_user_many(cls, user, notice_types):
+        """
+        Returns a dictionary mapping ``(notice_type_id, medium_id)`` to the
+        setting of ``user`` for each of ``notice_types`` and every medium.
+
+        Like ``for_user`` but with one query for the stored settings and one
+        bulk insert for the missing ones, skipping rows created concurrently.
+        """
+        def load():
+            return dict(
+                ((setting.notice_type_id, setting.medium), setting)
+                for setting in cls._default_manager.filter(user=user, notice_type__in=notice_types)
+            )
+        user_settings = load()
+        missing = [
+            cls(user=user, notice_type=notice_type, medium=medium_id,
+                send=cls.get_default(notice_type, medium_id))
+            for notice_type in notice_types
+            for medium_id, medium_display in NOTICE_MEDIA
+            if (notice_type.pk, medium_id) not in user_settings
+        ]
+        if missing and not cls.is_sparse():
+            bulk_insert_ignore(cls, missing, BULK_QUERY_SIZE, ("user", "notice_type", "medium"))
+            # read back primary keys and rows other writers got in first
+            user_settings = load()
+        for setting in missing:
+            user_settings.setdefault((setting.notice_type_id, setting.medium), setting)
+        return user_settings
+
+    def store(self):
+        """
+        Saves the setting. With sparse settings a setting equal to the
+        default is deleted instead, as it is implied.
+        """
+        if self.is_sparse() and self.send == self.get_default(self.notice_type, self.medium):
+            if self.pk is not None:
+                self.delete()
+                self.pk = None
+        else:
+            self.save()
+
+    @classmethod
+    def send_flags(cls, users, notice_type):
+        """
+        Returns a dictionary mapping ``(user_id, medium_id)`` to whether
+        notices of ``notice_type`` may be sent, for every user in ``users``
+        and every medium in ``NOTICE_MEDIA``.
+
+        Stored settings are read in set-based queries; missing ones are
+        worked out from ``NOTICE_MEDIA_DEFAULTS`` without being written. See
+        ``notification.preferences.send_flags`` for a cached variant.
+        """
+        user_ids = [user.pk for user in users]
+        flags = {}
+        for medium_id, medium_display in NOTICE_MEDIA:
+            default = cls.get_default(notice_type, medium_id)
+            for user_id in user_ids:
+                flags[(user_id, medium_id)] = default
+        for chunk in chunks(user_ids, BULK_QUERY_SIZE):
+            rows = cls._default_manager.filter(
+                notice_type=notice_type,
+                user__in=chunk
+            ).values_list("user", "medium", "send")
+            for user_id, medium_id, send in rows:
+                flags[(user_id, medium_id)] = send
+        return flags
+
+
+@receiver(post_save, sender=NoticeSetting)
+@receiver(post_delete, sender=NoticeSetting)
+def clear_preference_cache(sender, instance, **kwargs):
+    from notification import preferences
+    preferences.invalidate(instance.user_id)
 
 
 class NoticeManager(models.Manager):
@@ -181,12 +390,39 @@ class Notice(models.Model):
     on_site = models.BooleanField(_("on site"))
     target_url = models.URLField(_("target url"), null=True, blank=True)
     site = models.ForeignKey(Site, related_name="notice_site", default=settings.SITE_ID, verbose_name='site')
+    # identifies a notice within its TIME_INTERVAL_BTW_TWO_NOTIFICATION
+    # bucket; the unique index on it suppresses duplicate deliveries
+    dedupe_key = models.CharField(_("dedupe key"), max_length=40, unique=True, null=True, blank=True,
+                                  editable=False)
 
     objects = NoticeManager()
 
     def __unicode__(self):
         return self.message
 
+    def get_dedupe_key(self, when=None):
+        """
+        Returns a hash of recipient, notice type, sender, target url, on_site
+        and site together with the TIME_INTERVAL_BTW_TWO_NOTIFICATION bucket
+        ``when`` (default: now) falls into, or None if no interval is set.
+        """
+        interval = getattr(settings, "TIME_INTERVAL_BTW_TWO_NOTIFICATION", 0) * 60
+        if interval <= 0:
+            return None
+        if when is None:
+            when = timezone.now()
+        bucket = calendar.timegm(when.utctimetuple()) // interval
+        bits = [
+            self.recipient_id,
+            self.notice_type_id,
+            self.sender_id,
+            self.target_url or "",
+            int(bool(self.on_site)),
+            self.site_id,
+            int(bucket),
+        ]
+        return hashlib.sha1(force_bytes("|".join("%s" % bit for bit in bits))).hexdigest()
+
     def archive(self):
         self.archived = True
         self.save()
@@ -219,41 +455,378 @@ class NoticeLastSeen(models.Model):
     seen = models.DateTimeField(_("seen"), auto_now=True, editable=False)
 
 
+class NoticeQueueBatchManager(models.Manager):
+
+    def _available(self, now):
+        return self.filter(
+            models.Q(lease_expires__isnull=True) | models.Q(lease_expires__lt=now)
+        ).filter(
+            models.Q(next_attempt__isnull=True) | models.Q(next_attempt__lte=now)
+        )
+
+    def claim(self, worker, limit):
+        """
+        Leases up to ``limit`` queued batches, oldest first, to ``worker`` for
+        ``QUEUE_LEASE_SECONDS`` and returns them. Batches which are not leased
+        or whose lease expired are available, so batches left behind by a
+        worker which died are taken over automatically, unless a failed batch
+        is waiting for its ``next_attempt``.
+        """
+        now = timezone.now()
+        changes = {
+            "claimed_by": worker,
+            "lease_expires": now + datetime.timedelta(seconds=QUEUE_LEASE_SECONDS),
+            "attempts": models.F("attempts") + 1,
+        }
+        connection = connections[self.db]
+        if connection.vendor == "postgresql" and getattr(connection, "pg_version", 0) >= 90500:
+            # lock the oldest available rows, passing over those other
+            # workers are claiming at the same moment
+            qn = connection.ops.quote_name
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute(
+                    "SELECT {id} FROM {table} "
+                    "WHERE ({lease_expires} IS NULL OR {lease_expires} < %s) "
+                    "AND ({next_attempt} IS NULL OR {next_attempt} <= %s) "
+                    "ORDER BY {id} LIMIT %s FOR UPDATE SKIP LOCKED".format(
+                        id=qn("id"),
+                        table=qn(self.model._meta.db_table),  # pylint: disable-msg=W0212
+                        lease_expires=qn("lease_expires"),
+                        next_attempt=qn("next_attempt"),
+                    ),
+                    [now, now, limit]
+                )
+                claimed = [row[0] for row in cursor.fetchall()]
+                if claimed:
+                    self.filter(pk__in=claimed).update(**changes)
+        else:
+            # compare and set: a row is only taken if its lease is unchanged
+            # since it was read, so concurrent workers never share a batch
+            claimed = []
+            candidates = self._available(now).order_by("pk").values_list("pk", "lease_expires")
+            for pk, lease_expires in candidates[:limit]:
+                if lease_expires is None:
+                    batch = self.filter(pk=pk, lease_expires__isnull=True)
+                else:
+                    batch = self.filter(pk=pk, lease_expires=lease_expires)
+                if batch.update(**changes):
+                    claimed.append(pk)
+        if not claimed:
+            return []
+        return list(self.filter(pk__in=claimed, claimed_by=worker).order_by("pk"))
+
+    def extend(self, worker, pks):
+        """
+        Renews the lease ``worker`` holds on the batches ``pks`` and returns
+        the set of those it still holds.
+        """
+        now = timezone.now()
+        held = self.filter(pk__in=pks, claimed_by=worker, lease_expires__gte=now)
+        held.update(lease_expires=now + datetime.timedelta(seconds=QUEUE_LEASE_SECONDS))
+        return set(
+            self.filter(pk__in=pks, claimed_by=worker, lease_expires__gt=now).values_list("pk", flat=True)
+        )
+
+    def release(self, worker):
+        """
+        Gives up every lease held by ``worker``. The batches were not tried,
+        so their claims are not counted as attempts.
+        """
+        self.filter(claimed_by=worker).update(
+            claimed_by="", lease_expires=None, attempts=models.F("attempts") - 1
+        )
+
+
 class NoticeQueueBatch(models.Model):
     """
     A queued notice.
     Denormalized data for a notice.
     """
-    pickled_data = models.TextField()
+    # batches queued before the payload format existed
+    pickled_data = models.TextField(blank=True)
+    payload = models.BinaryField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=255, blank=True, default="", editable=False)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
+    attempts = models.PositiveIntegerField(default=0, editable=False)
+    # last checkpoint of a batch partly sent, see get_progress
+    progress = models.TextField(blank=True, default="", editable=False)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True, editable=False)
+    last_error = models.TextField(blank=True, default="", editable=False)
+
+    objects = NoticeQueueBatchManager()
+
+    def fail(self, error):
+        """
+        Records a failed attempt at sending the batch. The batch is retried
+        after QUEUE_RETRY_DELAY seconds, doubled for every further attempt,
+        or moved to the dead letters once it failed QUEUE_MAX_ATTEMPTS times.
+        Returns the NoticeQueueDeadLetter in the latter case.
+        """
+        if self.attempts >= QUEUE_MAX_ATTEMPTS:
+            with transaction.atomic():
+                dead_letter = NoticeQueueDeadLetter.objects.create(
+                    pickled_data=self.pickled_data,
+                    payload=self.payload,
+                    progress=self.progress,
+                    attempts=self.attempts,
+                    last_error=error,
+                )
+                self.delete()
+            return dead_letter
+        delay = QUEUE_RETRY_DELAY * 2 ** max(self.attempts - 1, 0)
+        self.last_error = error
+        self.next_attempt = timezone.now() + datetime.timedelta(seconds=delay)
+        NoticeQueueBatch.objects.filter(pk=self.pk, claimed_by=self.claimed_by).update(
+            claimed_by="",
+            lease_expires=None,
+            next_attempt=self.next_attempt,
+            last_error=error,
+        )
+
+    def get_progress(self):
+        """
+        Returns the ``(index, position)`` of the last checkpoint: the notices
+        before the ``index``-th of the batch were sent, and that one up to
+        ``position``, an offset into its recipients or the primary key of
+        the last recipient of an audience. ``(0, None)`` if there is none.
+        """
+        if not self.progress:
+            return 0, None
+        index, position = json.loads(self.progress)
+        return index, position
+
+    def checkpoint(self, index, position):
+        """
+        Records progress as described for ``get_progress`` and renews the
+        lease on the batch. Returns False if the lease was lost to another
+        worker, in which case nothing is recorded.
+        """
+        self.progress = json.dumps([index, position])
+        return bool(NoticeQueueBatch.objects.filter(pk=self.pk, claimed_by=self.claimed_by).update(
+            progress=self.progress,
+            lease_expires=timezone.now() + datetime.timedelta(seconds=QUEUE_LEASE_SECONDS),
+        ))
+
+    def replace(self, payloads):
+        """
+        Replaces the batch by new batches with the given payloads, in one
+        transaction. Returns False if the lease was lost to another worker,
+        in which case nothing is changed.
+        """
+        with transaction.atomic():
+            # renewing the lease locks the row against other workers
+            if not self.renew_lease():
+                return False
+            NoticeQueueBatch.objects.bulk_create([
+                NoticeQueueBatch(payload=payload) for payload in payloads
+            ])
+            self.delete()
+        notices_queued.send(sender=NoticeQueueBatch, batches=len(payloads))
+        return True
+
+    def renew_lease(self):
+        """
+        Renews the lease on the batch. Returns False if it was lost to
+        another worker.
+        """
+        return bool(NoticeQueueBatch.objects.filter(pk=self.pk, claimed_by=self.claimed_by).update(
+            lease_expires=timezone.now() + datetime.timedelta(seconds=QUEUE_LEASE_SECONDS),
+        ))
 
 
-def get_notification_language(user):
+class NoticeQueueDeadLetter(models.Model):
     """
-    Returns site-specific notification language for this user. Raises
-    LanguageStoreNotAvailable if this site does not use translated
-    notifications.
+    A queued batch given up on after failing QUEUE_MAX_ATTEMPTS times.
     """
+    pickled_data = models.TextField(blank=True)
+    payload = models.BinaryField(null=True, blank=True)
+    progress = models.TextField(blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    failed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = _("dead queued batch")
+        verbose_name_plural = _("dead queued batches")
 
-    if getattr(settings, "NOTIFICATION_LANGUAGE_MODULE", False):
+    def requeue(self):
+        """
+        Queues the batch again, with its attempts reset, and returns it.
+        """
+        with transaction.atomic():
+            batch = NoticeQueueBatch.objects.create(
+                pickled_data=self.pickled_data,
+                payload=self.payload,
+                progress=self.progress,
+            )
+            self.delete()
+        return batch
+
+
+# how long looked up notification languages are cached in-process, in seconds
+LANGUAGE_CACHE_TIMEOUT = getattr(settings, "NOTIFICATION_LANGUAGE_CACHE_TIMEOUT", 300)
+# the cache is emptied whenever it grows beyond this many users
+LANGUAGE_CACHE_SIZE = getattr(settings, "NOTIFICATION_LANGUAGE_CACHE_SIZE", 10000)
+
+# marks users the language store has nothing for
+_NOT_STORED = object()
+# (NOTIFICATION_LANGUAGE_MODULE, user id) -> (language, expiry timestamp)
+_language_cache = {}
+# NOTIFICATION_LANGUAGE_MODULE -> model class
+_language_models = {}
+
+
+def get_language_model():
+    """
+    Returns the model named by NOTIFICATION_LANGUAGE_MODULE, or None if the
+    setting is not defined. Raises LanguageStoreNotAvailable if the model
+    cannot be found.
+    """
+    module = getattr(settings, "NOTIFICATION_LANGUAGE_MODULE", False)
+    if not module:
+        return None
+    if module not in _language_models:
         try:
-            app_label, model_name = settings.NOTIFICATION_LANGUAGE_MODULE.split(".")
+            app_label, model_name = module.split(".")
             model = models.get_model(app_label, model_name)
-            # pylint: disable-msg=W0212
-            language_model = model._default_manager.get(user__id__exact=user.id)
-            if hasattr(language_model, "default_language"):
-                return language_model.default_language
-        except (ImportError, ImproperlyConfigured, model.DoesNotExist):
+        except (ValueError, ImportError, ImproperlyConfigured):
             raise LanguageStoreNotAvailable
-    else:
-        try:
-            language_model = User.objects.get(id=user.id)
-            if not hasattr(language_model, "user_profile"):
-                raise LanguageStoreNotAvailable
-            language_model = language_model.user_profile
-            if hasattr(language_model, "default_language"):
-                return language_model.default_language
-        except (ImportError, ImproperlyConfigured, User.DoesNotExist):
+        if model is None:
             raise LanguageStoreNotAvailable
+        _language_models[module] = model
+    return _language_models[module]
+
+
+def _load_notification_languages(user_ids):
+    """
+    Reads the stored language of each of ``user_ids`` in a single query.
+    """
+    languages = {}
+    model = get_language_model()
+    if model is not None:
+        # pylint: disable-msg=W0212
+        for language_model in model._default_manager.filter(user__id__in=user_ids):
+            languages[language_model.user_id] = getattr(language_model, "default_language", None)
+    elif hasattr(User, "user_profile"):
+        for user in User.objects.filter(id__in=user_ids).select_related("user_profile"):
+            language = _profile_language(user)
+            if language is not _NOT_STORED:
+                languages[user.id] = language
+    return languages
+
+
+def _profile_language(user):
+    try:
+        profile = user.user_profile
+    except ObjectDoesNotExist:
+        return _NOT_STORED
+    return getattr(profile, "default_language", None)
+
+
+def get_notification_languages(user_ids):
+    """
+    Returns a dictionary mapping those of ``user_ids`` with a stored
+    notification language to that language. Users not cached yet are looked
+    up with one query per chunk against NOTIFICATION_LANGUAGE_MODULE or the
+    user profile. Raises LanguageStoreNotAvailable if the configured language
+    model cannot be found.
+    """
+    source = getattr(settings, "NOTIFICATION_LANGUAGE_MODULE", None)
+    now = time.time()
+    languages, missing = {}, []
+    for user_id in user_ids:
+        language, expires = _language_cache.get((source, user_id), (None, 0))
+        if expires < now:
+            missing.append(user_id)
+        elif language is not _NOT_STORED:
+            languages[user_id] = language
+
+    if len(_language_cache) + len(missing) > LANGUAGE_CACHE_SIZE:
+        _language_cache.clear()
+    for chunk in chunks(missing, BULK_QUERY_SIZE):
+        loaded = _load_notification_languages(chunk)
+        for user_id in chunk:
+            language = loaded.get(user_id, _NOT_STORED)
+            if LANGUAGE_CACHE_TIMEOUT > 0:
+                _language_cache[(source, user_id)] = (language, now + LANGUAGE_CACHE_TIMEOUT)
+            if language is not _NOT_STORED:
+                languages[user_id] = language
+    return languages
+
+
+def load_recipients(user_ids):
+    """
+    Returns a dictionary mapping each of ``user_ids`` that exists to its user,
+    fetched with one query per chunk together with the user profile. When the
+    profile is the language store, the languages read along with it are
+    cached for ``get_notification_languages``.
+    """
+    has_profile = hasattr(User, "user_profile")
+    queryset = User.objects.all()
+    if has_profile:
+        queryset = queryset.select_related("user_profile")
+    users = {}
+    for chunk in chunks(user_ids, BULK_QUERY_SIZE):
+        users.update(queryset.in_bulk(chunk))
+    if has_profile and LANGUAGE_CACHE_TIMEOUT > 0 and get_language_model() is None:
+        if len(_language_cache) + len(users) > LANGUAGE_CACHE_SIZE:
+            _language_cache.clear()
+        expires = time.time() + LANGUAGE_CACHE_TIMEOUT
+        for user_id, user in users.items():
+            _language_cache[(None, user_id)] = (_profile_language(user), expires)
+    return users
+
+
+def get_notification_language(user):
+    """
+    Returns site-specific notification language for this user. Raises
+    LanguageStoreNotAvailable if this site does not use translated
+    notifications.
+    """
+    languages = get_notification_languages([user.id])
+    if user.id not in languages:
+        raise LanguageStoreNotAvailable
+    return languages[user.id]
+
+
+_language_codes = None
+
+
+def get_language_code(language):
+    """
+    Returns the code of the ``settings.LANGUAGES`` entry whose code or name is
+    ``language``, or DEFAULT_LANGUAGE if there is none.
+    """
+    global _language_codes
+    if _language_codes is None:
+        codes = {}
+        for code, name in settings.LANGUAGES:
+            codes.setdefault(force_text(name), code)
+        for code, name in settings.LANGUAGES:
+            codes[code] = code
+        _language_codes = codes
+    return _language_codes.get(force_text(language), DEFAULT_LANGUAGE)
+
+
+def partition_by_language(users, extra_context):
+    """
+    Groups ``users`` by their notification language and returns a list of
+    ``(language, users)`` tuples in order of first appearance. The language is
+    None for users without a stored language. An explicit
+    ``extra_context['language_code']`` applies to all of them.
+    """
+    users = list(users)
+    if 'language_code' in extra_context:
+        return [(get_language_code(extra_context['language_code']), users)]
+    try:
+        languages = get_notification_languages([user.pk for user in users])
+    except LanguageStoreNotAvailable:
+        languages = {}
+    groups = OrderedDict()
+    for user in users:
+        groups.setdefault(languages.get(user.pk), []).append(user)
+    return list(groups.items())
 
 
 def send_now(users, label, extra_context=None, sender=None):
@@ -267,48 +840,150 @@ def send_now(users, label, extra_context=None, sender=None):
         "foo": "bar",
     })
     """
+    return bool(fan_out(users, label, extra_context, sender))
 
-    sent = False
+
+def fan_out(users, label, extra_context=None, sender=None):
+    """
+    Delivers one notice to all of ``users`` like ``send_now`` and returns the
+    set of primary keys of the users it was handed to a backend for.
+    """
     if extra_context is None:
         extra_context = {}
 
-    notice_type = NoticeType.objects.get(label=label)
+    notice_type = NoticeType.objects.get_cached(label)
+    users = list(users)
+    active = active_backends(extra_context)
+    recipients = allowed_recipients(users, notice_type, active)
+    target = extra_context.get('target')
+    title = getattr(target, 'title', None)
 
     current_language = get_language()
-
-    for user in users:
-        # get user language for user from language store defined in
-        # NOTIFICATION_LANGUAGE_MODULE setting
-        try:
-            language = get_notification_language(user)
-        except LanguageStoreNotAvailable:
-            language = None
-
-        if language is not None:
-            # activate the user's language
-            activate(language)
-            # activate('ru')
-
-            if 'target' in extra_context and hasattr(extra_context['target'], 'translations'):
-                try:
-                    extra_context['target'].title = extra_context['target'].translations.get(language_code='ru').title
-                except:
-                    pass
-
-
-        for backend in NOTIFICATION_BACKENDS.values():
-            if backend.can_send(user, notice_type):
-                if ('disallow_notice' in extra_context
-                    and not [True for b_end in extra_context['disallow_notice'] if b_end in NOTIFICATION_BACKENDS.keys()])\
-                        or 'disallow_notice' not in extra_context:
-                    backend.deliver(user, sender, notice_type, extra_context)
-                    sent = True
+    sent, deferred = set(), {}
+
+    with backends.opened(active.values()):
+        # activate every language once and hand each backend all of the
+        # group's recipients it may deliver to in a single call
+        for language, group in partition_by_language(users, extra_context):
+            activate(language or DEFAULT_LANGUAGE)
+            translate_target(target, language, title)
+            # the backends look the recipients' languages up again from the
+            # cache, and activate them as stored like they always did
+            group_context = dict(extra_context)
+
+            for key, backend in active.items():
+                group_recipients = [user for user in group if user.pk in recipients[key]]
+                if not group_recipients:
+                    continue
+                delivered = deliver_guarded(
+                    key[1], backend, group_recipients, sender, notice_type, group_context
+                )
+                if delivered:
+                    sent.update(user.pk for user in group_recipients)
+                else:
+                    deferred.setdefault(key[1], []).extend(user.pk for user in group_recipients)
 
     # reset environment to original language
     activate(current_language)
+    translate_target(target, None, title)
+    for backend_label, user_ids in deferred.items():
+        defer(user_ids, backend_label, label, extra_context, sender)
     return sent
 
 
+def active_backends(extra_context):
+    """
+    Returns the backends of NOTIFICATION_BACKENDS not named in the
+    ``disallow_notice`` list of ``extra_context``.
+    """
+    disallowed = extra_context.get('disallow_notice', ())
+    return dict(
+        (key, backend) for key, backend in NOTIFICATION_BACKENDS.items() if key[1] not in disallowed
+    )
+
+
+def allowed_recipients(users, notice_type, active):
+    """
+    Returns a dictionary mapping each key of ``active`` to the set of primary
+    keys of the ``users`` that backend may deliver ``notice_type`` to, worked
+    out from the cached preference bitmaps instead of one query per user and
+    medium.
+    """
+    from notification import preferences
+
+    send_flags = preferences.send_flags(users, notice_type)
+    return dict(
+        (key, set(user.pk for user in backend.can_send_many(users, notice_type, send_flags)))
+        for key, backend in active.items()
+    )
+
+
+def translate_target(target, language, default):
+    """
+    Sets the title of a translatable notice ``target`` to its translation
+    into ``language``, or to ``default`` if there is none.
+    """
+    if not hasattr(target, 'translations'):
+        return
+    title = default
+    if language is not None:
+        try:
+            title = target.translations.get(language_code=language).title
+        except ObjectDoesNotExist:
+            pass
+    target.title = title
+
+
+def deliver_guarded(backend_label, backend, recipients, sender, notice_type, extra_context):
+    """
+    Hands ``recipients`` to ``backend`` unless its circuit breaker is open
+    and records in the breaker how the delivery went. Returns False if the
+    recipients were not delivered to and should be deferred. Errors are
+    raised as before while the breaker stays closed, so that they are
+    retried with the batch.
+    """
+    breaker = get_breaker(backend_label)
+    if not breaker.allow():
+        return False
+    start = time.time()
+    try:
+        backend.deliver_many(recipients, sender, notice_type, extra_context)
+    except Exception:
+        breaker.record(False, time.time() - start, len(recipients))
+        if breaker.state == CLOSED:
+            raise
+        logging.exception("delivering through {} failed, deferring {} recipients".format(
+            backend_label, len(recipients)
+        ))
+        return False
+    breaker.record(True, time.time() - start, len(recipients))
+    return True
+
+
+def defer(user_ids, backend_label, label, extra_context, sender):
+    """
+    Queues a notice again for ``user_ids`` which the backend
+    ``backend_label`` did not deliver because its circuit breaker is open.
+    The batches go through that backend only and are sent once the breaker
+    lets a probe through.
+    """
+    from notification.payload import encode_payload
+    breaker = get_breaker(backend_label)
+    others = [key[1] for key in NOTIFICATION_BACKENDS if key[1] != backend_label]
+    extra_context = dict(
+        extra_context, disallow_notice=list(extra_context.get('disallow_notice', ())) + others
+    )
+    next_attempt = timezone.now() + datetime.timedelta(seconds=breaker.open_seconds)
+    NoticeQueueBatch.objects.bulk_create([
+        NoticeQueueBatch(
+            payload=encode_payload(shard, label, extra_context, sender),
+            next_attempt=next_attempt,
+            last_error="circuit breaker of backend {} is open".format(backend_label),
+        )
+        for shard in chunks(user_ids, QUEUE_BATCH_SIZE)
+    ])
+
+
 def send(*args, **kwargs):
     """
     A basic interface around both queue and send_now. This honors a global
@@ -336,13 +1011,31 @@ def queue(users, label, extra_context=None, sender=None):
     of user notifications to be deferred to a seperate process running outside
     the webserver.
     """
+    from notification.payload import encode_payload
     if extra_context is None:
         extra_context = {}
     if isinstance(users, QuerySet):
-        users = [row["pk"] for row in users.values("pk")]
-    else:
+        if LAZY_QUERYSETS and QueryAudience.supports(users):
+            # store the query, the recipients are looked up when sending
+            users = QueryAudience(users)
+        else:
+            users = [row["pk"] for row in users.values("pk")]
+    elif not isinstance(users, BaseAudience):
         users = [user.pk for user in users]
-    notices = []
-    for user in users:
-        notices.append((user, label, extra_context, sender))
-    NoticeQueueBatch(pickled_data=base64.b64encode(pickle.dumps(notices))).save()
+    if isinstance(users, BaseAudience):
+        shards = [users]
+    else:
+        # split large calls so several workers can share them and a failure
+        # only affects one shard
+        shards = list(chunks(users, QUEUE_BATCH_SIZE)) or [users]
+    NoticeQueueBatch.objects.bulk_create([
+        NoticeQueueBatch(payload=encode_payload(shard, label, extra_context, sender))
+        for shard in shards
+    ])
+    notices_queued.send(sender=NoticeQueueBatch, batches=len(shards))
+
+
+@receiver(notices_queued)
+def wake_emitters(sender, **kwargs):
+    from notification import wakeup
+    wakeup.notify()
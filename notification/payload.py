@@ -0,0 +1,212 @@
+"""
+Storage format of queued notice batches.
+
+A payload starts with the magic ``NQ``, a format version and a flags byte.
+The body, zlib compressed when FLAG_COMPRESSED is set, holds the length of
+the pickled ``(label, extra_context, sender)`` notice, that notice and then
+the primary keys of its recipients packed as unsigned 64 bit integers, or
+pickled when FLAG_PICKLED_IDS is set because they are not integers. With
+FLAG_AUDIENCE the notice is followed by a pickled audience instead, see
+``notification.audiences``.
+
+Model instances in the extra context or as sender are stored as
+ModelReferences to their content type and primary key rather than pickled
+whole, and loaded again when the batch is sent; see ``resolve_references``.
+
+Batches queued before this format existed keep their base64 encoded pickle
+of ``(user_id, label, extra_context, sender)`` tuples in ``pickled_data`` and
+are still read by ``load_batch``.
+"""
+import base64
+import logging
+import struct
+import zlib
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import six
+from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
+
+from notification.audiences import BaseAudience
+
+
+# compress payloads whose body is at least this many bytes; None disables it
+COMPRESS_MIN_SIZE = getattr(settings, "NOTIFICATION_QUEUE_COMPRESS_MIN_SIZE", 1024)
+# queue model instances by reference instead of pickling them
+MODEL_REFERENCES = getattr(settings, "NOTIFICATION_QUEUE_MODEL_REFERENCES", True)
+
+MAGIC = b"NQ"
+VERSION = 1
+FLAG_COMPRESSED = 1
+FLAG_PICKLED_IDS = 2
+FLAG_AUDIENCE = 4
+# pickles must stay readable by workers on either Python 2 or 3
+PICKLE_PROTOCOL = 2
+
+_prefix = struct.Struct("!2sBB")
+_length = struct.Struct("!I")
+
+
+class PayloadError(ValueError):
+    pass
+
+
+ModelReference = namedtuple("ModelReference", ["content_type_id", "pk"])
+
+
+def make_reference(value):
+    """
+    Returns a ModelReference to ``value`` if it is a saved model instance,
+    else ``value`` itself.
+    """
+    if MODEL_REFERENCES and isinstance(value, models.Model) and value.pk is not None:
+        return ModelReference(ContentType.objects.get_for_model(value).pk, value.pk)
+    return value
+
+
+def resolve_references(notices):
+    """
+    Returns ``notices``, a list of ``(user_ids, label, extra_context,
+    sender)`` tuples, with the ModelReferences in their extra context and
+    sender replaced by the current instances. Every content type is loaded
+    with a single query. References to instances deleted since are replaced
+    by None.
+    """
+    wanted = {}
+    for user_ids, label, extra_context, sender in notices:
+        for value in list(extra_context.values()) + [sender]:
+            if isinstance(value, ModelReference):
+                wanted.setdefault(value.content_type_id, set()).add(value.pk)
+    if not wanted:
+        return notices
+    instances = _load_references(wanted)
+
+    def resolve(value):
+        if isinstance(value, ModelReference):
+            return instances[value]
+        return value
+
+    def resolve_context(extra_context):
+        return dict((key, resolve(value)) for key, value in extra_context.items())
+    return [
+        (user_ids, label, resolve_context(extra_context), resolve(sender))
+        for user_ids, label, extra_context, sender in notices
+    ]
+
+
+def _load_references(wanted):
+    """
+    Returns a dictionary mapping a ModelReference for each of the primary
+    keys in ``wanted``, a dictionary of content type ids to sets of primary
+    keys, to its instance or None. Loads each content type with one query.
+    """
+    instances = {}
+    for content_type_id, pks in wanted.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        loaded = {}
+        if model is not None:
+            loaded = model._default_manager.in_bulk(list(pks))  # pylint: disable-msg=W0212
+        for pk in pks:
+            if pk not in loaded:
+                logging.warning("queued notice refers to {} {} which no longer exists".format(
+                    model.__name__ if model else content_type_id, pk
+                ))
+            instances[ModelReference(content_type_id, pk)] = loaded.get(pk)
+    return instances
+
+
+def encode_payload(user_ids, label, extra_context, sender):
+    """
+    Returns the payload of a batch delivering one notice to ``user_ids``, a
+    list of primary keys or an audience.
+    """
+    flags = 0
+    extra_context = dict((key, make_reference(value)) for key, value in extra_context.items())
+    notice = pickle.dumps((label, extra_context, make_reference(sender)), PICKLE_PROTOCOL)
+    if isinstance(user_ids, BaseAudience):
+        ids = pickle.dumps(user_ids, PICKLE_PROTOCOL)
+        flags |= FLAG_AUDIENCE
+    elif all(isinstance(user_id, six.integer_types) for user_id in user_ids):
+        ids = struct.pack("!%dQ" % len(user_ids), *user_ids)
+    else:
+        ids = pickle.dumps(list(user_ids), PICKLE_PROTOCOL)
+        flags |= FLAG_PICKLED_IDS
+    body = _length.pack(len(notice)) + notice + ids
+    if COMPRESS_MIN_SIZE is not None and len(body) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_COMPRESSED
+    return _prefix.pack(MAGIC, VERSION, flags) + body
+
+
+def decode_payload(data):
+    """
+    Returns the ``(user_ids, label, extra_context, sender)`` stored in the
+    payload ``data``, model references still unresolved. ``user_ids`` is an
+    audience for FLAG_AUDIENCE payloads. Raises PayloadError
+    if it is not a payload of a known version.
+    """
+    data = memoryview(data).tobytes()
+    try:
+        magic, version, flags = _prefix.unpack_from(data)
+    except struct.error:
+        raise PayloadError("truncated payload")
+    if magic != MAGIC:
+        raise PayloadError("not a notice payload")
+    if version != VERSION:
+        raise PayloadError("unsupported payload version %s" % version)
+    body = data[_prefix.size:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+    length, = _length.unpack_from(body)
+    start = _length.size
+    label, extra_context, sender = pickle.loads(body[start:start + length])
+    ids = body[start + length:]
+    if flags & (FLAG_PICKLED_IDS | FLAG_AUDIENCE):
+        user_ids = pickle.loads(ids)
+    else:
+        user_ids = list(struct.unpack("!%dQ" % (len(ids) // 8), ids))
+    return user_ids, label, extra_context, sender
+
+
+def _same(a, b):
+    if a is b:
+        return True
+    try:
+        return bool(a == b)
+    except Exception:  # pylint: disable-msg=W0703
+        return False
+
+
+def group_notices(notices):
+    """
+    Groups consecutive queued ``(user_id, label, extra_context, sender)``
+    tuples which share label, extra context and sender, and yields a
+    ``(user_ids, label, extra_context, sender)`` tuple for each group.
+    """
+    group = None
+    for user_id, label, extra_context, sender in notices:
+        if group is not None and label == group[1] and \
+                _same(extra_context, group[2]) and _same(sender, group[3]):
+            group[0].append(user_id)
+            continue
+        if group is not None:
+            yield group
+        group = ([user_id], label, extra_context, sender)
+    if group is not None:
+        yield group
+
+
+def load_batch(queued_batch):
+    """
+    Returns the notices of ``queued_batch`` as a list of
+    ``(user_ids, label, extra_context, sender)`` tuples, whichever format
+    the batch was queued in.
+    """
+    if queued_batch.payload:
+        return [decode_payload(queued_batch.payload)]
+    notices = pickle.loads(base64.b64decode(queued_batch.pickled_data))
+    return list(group_notices(notices))
@@ -0,0 +1,135 @@
+"""
+Cached per-user notification preferences.
+
+Each user's full preference matrix is stored in the cache framework as a
+bitmap with one bit per notice type and medium, set when notices of that type
+are sent on that medium. Bitmaps are built from the user's NoticeSetting rows
+and the media defaults in one query, and cache keys carry the notice
+type registry version so changes to notice types invalidate all of them.
+
+Dropping a user's bitmap when their settings change only reaches processes
+sharing the cache. With a cache kept in each process (``LocMemCache``, the
+default) bitmaps are only kept for ``NOTIFICATION_PREFERENCE_LOCAL_CACHE_TIMEOUT``
+seconds, so changes made in another process are seen that soon.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+from notification.models import NoticeSetting, NoticeType
+from notification.models import NOTICE_MEDIA, BULK_QUERY_SIZE
+from notification.utils import chunks
+
+
+PREFERENCE_CACHE_TIMEOUT = getattr(settings, "NOTIFICATION_PREFERENCE_CACHE_TIMEOUT", 60 * 60)
+# used instead when the cache is not shared between processes
+LOCAL_CACHE_TIMEOUT = getattr(settings, "NOTIFICATION_PREFERENCE_LOCAL_CACHE_TIMEOUT", 5)
+
+
+def _bit(notice_type_id, medium_id):
+    return notice_type_id * len(NOTICE_MEDIA) + medium_id
+
+
+def _cache_key(user_id):
+    return "notification:preferences:%s:%s" % (NoticeType.objects.get_version(), user_id)
+
+
+def get_cache_timeout():
+    """
+    Returns the number of seconds bitmaps are cached for, which is bounded
+    by ``LOCAL_CACHE_TIMEOUT`` when the cache is kept in each process.
+    """
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return min(PREFERENCE_CACHE_TIMEOUT, LOCAL_CACHE_TIMEOUT)
+    return PREFERENCE_CACHE_TIMEOUT
+
+
+def _load_bitmaps(user_ids):
+    notice_types = NoticeType.objects.all_cached()
+    defaults = 0
+    for notice_type in notice_types:
+        for medium_id, medium_display in NOTICE_MEDIA:
+            if NoticeSetting.get_default(notice_type, medium_id):
+                defaults |= 1 << _bit(notice_type.pk, medium_id)
+    bitmaps = dict((user_id, defaults) for user_id in user_ids)
+    for chunk in chunks(user_ids, BULK_QUERY_SIZE):
+        rows = NoticeSetting.objects.filter(
+            user__in=chunk
+        ).values_list("user", "notice_type", "medium", "send")
+        for user_id, notice_type_id, medium_id, send in rows:
+            if send:
+                bitmaps[user_id] |= 1 << _bit(notice_type_id, medium_id)
+            else:
+                bitmaps[user_id] &= ~(1 << _bit(notice_type_id, medium_id))
+    # remember which notice types the bitmaps cover; ones created later are
+    # looked up in the database until the registry version changes
+    covered = max([notice_type.pk for notice_type in notice_types] or [0])
+    return dict((user_id, (bitmap, covered)) for user_id, bitmap in bitmaps.items())
+
+
+def get_bitmaps(user_ids):
+    """
+    Returns a dictionary mapping each of ``user_ids`` to its preference
+    bitmap. Users missing from the cache are loaded with one query per chunk
+    and cached.
+    """
+    bitmaps = {}
+    for chunk in chunks(user_ids, BULK_QUERY_SIZE):
+        keys = dict((_cache_key(user_id), user_id) for user_id in chunk)
+        for key, bitmap in cache.get_many(list(keys)).items():
+            bitmaps[keys[key]] = bitmap
+        missing = [user_id for user_id in chunk if user_id not in bitmaps]
+        if missing:
+            loaded = _load_bitmaps(missing)
+            cache.set_many(
+                dict((_cache_key(user_id), bitmap) for user_id, bitmap in loaded.items()),
+                get_cache_timeout()
+            )
+            bitmaps.update(loaded)
+    return bitmaps
+
+
+def allows(bitmap, notice_type, medium_id):
+    """
+    Returns whether ``bitmap`` allows sending ``notice_type`` on the given
+    medium, or None if the bitmap predates the notice type.
+    """
+    bits, covered = bitmap
+    if notice_type.pk > covered:
+        return None
+    return bool(bits >> _bit(notice_type.pk, medium_id) & 1)
+
+
+def can_send(user, notice_type, medium_id):
+    """
+    Returns whether notices of ``notice_type`` may be sent to ``user`` on the
+    given medium.
+    """
+    allowed = allows(get_bitmaps([user.pk])[user.pk], notice_type, medium_id)
+    if allowed is None:
+        return NoticeSetting.for_user(user, notice_type, medium_id).send
+    return allowed
+
+
+def send_flags(users, notice_type):
+    """
+    Cached counterpart of ``NoticeSetting.send_flags``.
+    """
+    users = list(users)
+    bitmaps = get_bitmaps([user.pk for user in users])
+    flags = {}
+    for user in users:
+        for medium_id, medium_display in NOTICE_MEDIA:
+            allowed = allows(bitmaps[user.pk], notice_type, medium_id)
+            if allowed is None:
+                return NoticeSetting.send_flags(users, notice_type)
+            flags[(user.pk, medium_id)] = allowed
+    return flags
+
+
+def invalidate(user_id):
+    """
+    Drops the cached preferences of the given user.
+    """
+    cache.delete(_cache_key(user_id))
@@ -0,0 +1,107 @@
+from django.conf import settings
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import get_template
+from django.utils import translation
+
+
+CACHE_TEMPLATES = getattr(settings, "NOTIFICATION_CACHE_TEMPLATES", True)
+
+# template name -> compiled Template, or None when it does not exist
+_templates = {}
+
+
+def get_cached_template(name):
+    """
+    Returns the compiled template called ``name``, or None if there is no such
+    template. Both outcomes are remembered for the life of the process.
+    """
+    try:
+        return _templates[name]
+    except KeyError:
+        pass
+    try:
+        template = get_template(name)
+    except TemplateDoesNotExist:
+        template = None
+    if CACHE_TEMPLATES:
+        _templates[name] = template
+    return template
+
+
+def select_cached_template(names):
+    """
+    Like ``django.template.loader.select_template`` but backed by
+    ``get_cached_template``.
+    """
+    for name in names:
+        template = get_cached_template(name)
+        if template is not None:
+            return template
+    raise TemplateDoesNotExist(", ".join(names))
+
+
+def clear_template_cache():
+    _templates.clear()
+
+
+class TrackingContext(Context):
+    """
+    A Context recording the variable names looked up in it while rendering.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TrackingContext, self).__init__(*args, **kwargs)
+        self.accessed = set()
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return super(TrackingContext, self).__getitem__(key)
+
+    def __contains__(self, key):
+        self.accessed.add(key)
+        return super(TrackingContext, self).__contains__(key)
+
+    def get(self, key, otherwise=None):
+        self.accessed.add(key)
+        return super(TrackingContext, self).get(key, otherwise)
+
+
+class MessageRenderer(object):
+    """
+    Renders notification templates for the recipients of a single notice.
+
+    When rendering a template with a ``TrackingContext`` does not look up any
+    of ``recipient_keys``, the output is kept and reused for every further
+    recipient in the same language rather than rendered again.
+    """
+    def __init__(self, recipient_keys=("recipient", "target_url")):
+        self.recipient_keys = frozenset(recipient_keys)
+        self._shared = {}
+
+    def render(self, template_names, context, dictionary=None):
+        dictionary = dictionary or {}
+        key = (
+            translation.get_language(),
+            tuple(template_names),
+            context.autoescape,
+            tuple(sorted(dictionary.items())),
+        )
+        try:
+            if key in self._shared:
+                return self._shared[key]
+        except TypeError:
+            # unhashable values in ``dictionary``, never share the output
+            key = None
+
+        template = select_cached_template(template_names)
+        tracking = isinstance(context, TrackingContext)
+        if tracking:
+            context.accessed = set()
+        context.update(dictionary)
+        try:
+            output = template.render(context)
+        finally:
+            context.pop()
+
+        if key is not None and tracking and not (context.accessed & self.recipient_keys):
+            self._shared[key] = output
+        return output
@@ -5,3 +5,10 @@ import django.dispatch
 emitted_notices = django.dispatch.Signal(
     providing_args=["batches", "sent", "sent_actual", "run_time"]
 )
+
+# sent by ``notification.models.queue`` once it stored new batches
+notices_queued = django.dispatch.Signal(providing_args=["batches"])
+
+# sent by ``notification.breaker`` when the circuit breaker of a backend opens,
+# lets a probe through or closes again
+breaker_state_changed = django.dispatch.Signal(providing_args=["backend", "state", "previous"])
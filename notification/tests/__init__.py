@@ -1,3 +1,5 @@
+from django.db import connection
+
 from ..models import NOTICE_MEDIA
 
 
@@ -6,3 +8,13 @@ def get_backend_id(backend_name):
         if bname == backend_name:
             return bid
     return None
+
+
+def shares_database():
+    """
+    Returns whether other threads and processes see the test database, which
+    they do not for an in-memory sqlite database.
+    """
+    if connection.vendor != "sqlite":
+        return True
+    return connection.settings_dict.get("TEST_NAME") not in (None, "", ":memory:")
@@ -4,4 +4,4 @@ from ..compat import AUTH_USER_MODEL
 
 class Language(models.Model):
     user = models.ForeignKey(AUTH_USER_MODEL)
-    language = models.CharField("language", max_length=10)
+    default_language = models.CharField("language", max_length=10)
@@ -0,0 +1,221 @@
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.db import connection
+
+from ..backends import BaseBackend
+from ..backends import base as base_backend
+from ..backends import email as email_backend
+from ..backends.onsite import OnSiteBackend
+from ..compat import get_user_model
+from ..models import Notice, NoticeType, create_notice_type
+from .. import preferences
+from ..breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+from ..rendering import MessageRenderer, TrackingContext, get_cached_template
+from .. import rendering
+
+
+class RecordingBackend(BaseBackend):
+    def __init__(self, *args, **kwargs):
+        super(RecordingBackend, self).__init__(*args, **kwargs)
+        self.delivered = []
+
+    def deliver(self, recipient, sender, notice_type, extra_context):
+        self.delivered.append(recipient)
+
+
+class RejectingBackend(BaseBackend):
+    def can_send(self, user, notice_type):
+        return user.username != "rejected"
+
+
+class RejectingEmailBackend(email_backend.EmailBackend):
+    def can_send(self, user, notice_type):
+        return user.username != "rejected"
+
+
+class TestBaseBackend(TestCase):
+    def test_deliver_many_falls_back_to_deliver(self):
+        backend = RecordingBackend(0)
+        backend.deliver_many(["first", "second"], None, None, {})
+        self.assertEqual(backend.delivered, ["first", "second"])
+
+    def test_can_send_many_honours_can_send(self):
+        users = [
+            get_user_model().objects.create_user(username, "%s@user.com" % username, "123456")
+            for username in ("accepted", "rejected")
+        ]
+        create_notice_type("label", "display", "past tense", "description")
+        notice_type = NoticeType.objects.get(label="label")
+        send_flags = preferences.send_flags(users, notice_type)
+        for backend in (RejectingBackend(1), RejectingEmailBackend(1)):
+            self.assertTrue(backend.overrides_can_send())
+            self.assertEqual(backend.can_send_many(users, notice_type, send_flags), users[:1])
+        # the shipped backends keep using the send flags
+        self.assertFalse(email_backend.EmailBackend(1).overrides_can_send())
+        self.assertFalse(OnSiteBackend(0).overrides_can_send())
+
+
+@override_settings(TIME_INTERVAL_BTW_TWO_NOTIFICATION=10)
+class TestOnSiteBackend(TestCase):
+    def setUp(self):
+        self.sender = get_user_model().objects.create_user("sender", "sender@user.com", "123456")
+        create_notice_type("label", "display", "past tense", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+        self.bulk_create_size = base_backend.BULK_CREATE_SIZE
+
+    def tearDown(self):
+        base_backend.BULK_CREATE_SIZE = self.bulk_create_size
+
+    def users(self, count):
+        return [
+            get_user_model().objects.create_user("user{}".format(i), "", "123456")
+            for i in range(count)
+        ]
+
+    def deliver_many(self, recipients):
+        with CaptureQueriesContext(connection) as queries:
+            OnSiteBackend(0).deliver_many(recipients, self.sender, self.notice_type, {})
+        return len(queries)
+
+    def test_queries_do_not_grow_with_recipients(self):
+        users = self.users(6)
+        queries = self.deliver_many(users[:2])
+        self.assertEqual(self.deliver_many(users[2:]), queries)
+        self.assertEqual(Notice.objects.filter(on_site=True).count(), 6)
+
+    def test_one_lookup_and_insert_per_chunk(self):
+        users = self.users(5)
+        notices = [
+            Notice(recipient=user, notice_type=self.notice_type, sender=self.sender,
+                   message="message", on_site=True)
+            for user in users
+        ]
+        base_backend.BULK_CREATE_SIZE = 2
+        with CaptureQueriesContext(connection) as queries:
+            created = OnSiteBackend(0).create_notices(notices)
+        self.assertEqual(len(created), 5)
+        statements = [query["sql"] for query in queries]
+        # one lookup of the stored dedupe keys and one insert per chunk
+        self.assertEqual(len([sql for sql in statements if '"dedupe_key" FROM' in sql]), 3)
+        self.assertEqual(len([sql for sql in statements if "INSERT INTO" in sql]), 3)
+
+    def test_duplicates_suppressed(self):
+        users = self.users(3)
+        users[2].is_active = False
+        self.deliver_many(users[:2])
+        # a notice sent within the interval is not stored again
+        self.deliver_many(users)
+        self.assertEqual(
+            sorted(Notice.objects.values_list("recipient", flat=True)),
+            sorted(user.pk for user in users[:2])
+        )
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker("test", window=60, failure_rate=0.5, slow_delivery=1,
+                                      min_deliveries=4, open_seconds=30)
+
+    def test_opens_on_errors(self):
+        for ok in (True, False, True):
+            self.breaker.record(ok, 0.1, now=0)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.record(False, 0.1, now=1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow(now=2))
+
+    def test_opens_on_latency(self):
+        for _ in range(4):
+            self.breaker.record(True, 50, recipients=10, now=0)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_window(self):
+        for _ in range(3):
+            self.breaker.record(False, 0.1, now=0)
+        # the old failures have left the window
+        self.breaker.record(False, 0.1, now=100)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.snapshot(now=100)["deliveries"], 1)
+
+    def test_probe(self):
+        for _ in range(4):
+            self.breaker.record(False, 0.1, now=0)
+        self.assertTrue(self.breaker.allow(now=30))
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        # only one probe at a time
+        self.assertFalse(self.breaker.allow(now=30))
+        self.breaker.record(False, 0.1, now=31)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertTrue(self.breaker.allow(now=61))
+        self.breaker.record(True, 0.1, now=61)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow(now=62))
+
+
+class TestRendering(TestCase):
+    def test_missing_template_remembered(self):
+        name = "notification/no_such_label/full.txt"
+        self.assertIsNone(get_cached_template(name))
+        self.assertIn(name, rendering._templates)  # pylint: disable-msg=W0212
+
+    def test_label_fallback(self):
+        backend = RecordingBackend(0)
+        context = TrackingContext({"recipient": "bob"})
+        messages = backend.get_formatted_messages(
+            ("full.txt",), ("no_such_label", "recipient_label"), context)
+        self.assertEqual(messages["full.txt"].strip(), "bob")
+
+    def test_recipient_independent_output_shared(self):
+        renderer = MessageRenderer()
+        first = renderer.render(("notification/full.txt",), TrackingContext({"notice": "first"}))
+        second = renderer.render(("notification/full.txt",), TrackingContext({"notice": "second"}))
+        self.assertEqual(first, second)
+
+    def test_recipient_dependent_output_rendered(self):
+        renderer = MessageRenderer()
+        names = ("notification/recipient_label/full.txt",)
+        for recipient in ("bob", "alice"):
+            output = renderer.render(names, TrackingContext({"recipient": recipient}))
+            self.assertEqual(output.strip(), recipient)
+
+
+class TestEmailBackend(TestCase):
+    def setUp(self):
+        self.connections = []
+        self.get_connection = email_backend.get_connection
+        self.messages_per_connection = email_backend.MESSAGES_PER_CONNECTION
+
+        def get_connection(*args, **kwargs):
+            connection = self.get_connection(*args, **kwargs)
+            self.connections.append(connection)
+            return connection
+        email_backend.get_connection = get_connection
+        mail.outbox = []
+
+    def tearDown(self):
+        email_backend.get_connection = self.get_connection
+        email_backend.MESSAGES_PER_CONNECTION = self.messages_per_connection
+
+    def messages(self, count):
+        return [
+            EmailMessage("subject", "body", "from@example.com", ["to{}@example.com".format(i)])
+            for i in range(count)
+        ]
+
+    def test_one_connection_per_batch(self):
+        backend = email_backend.EmailBackend(0)
+        backend.open()
+        backend.send_messages(self.messages(3))
+        backend.send_messages(self.messages(2))
+        backend.close()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_connection_recycled(self):
+        email_backend.MESSAGES_PER_CONNECTION = 2
+        backend = email_backend.EmailBackend(0)
+        backend.send_messages(self.messages(5))
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(len(self.connections), 3)
@@ -1,22 +1,357 @@
-from django.test import TestCase
+import os
+import signal
+import smtplib
+import unittest
+
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from django.core import management, mail
+from django.utils import timezone
 
+from .. import models
 from ..compat import get_user_model
-from ..models import create_notice_type, queue
+from .. import audiences, breaker, engine, wakeup
+from ..engine import send_all, send_all_parallel, run_daemon
+from ..signals import emitted_notices
+from ..backends import email as email_backend
+from ..models import create_notice_type, queue, Notice, NoticeQueueBatch, NoticeQueueDeadLetter
+from ..payload import decode_payload, group_notices
+
+from . import shares_database
+
+
+class FailingConnection(object):
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        raise smtplib.SMTPServerDisconnected("relay went away")
 
 
 class TestManagementCmd(TestCase):
     def setUp(self):
         self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
         self.user2 = get_user_model().objects.create_user("test_user2", "test2@user.com", "123456")
-        create_notice_type("label", "display", "description")
+        create_notice_type("label", "display", "past tense", "description")
+        breaker.reset()
+
+    def tearDown(self):
+        breaker.reset()
 
     @override_settings(SITE_ID=1)
     def test_emit_notices(self):
         users = [self.user, self.user2]
-        queue(users, "label")
+        queue(users, "label", sender=self.user)
+        management.call_command("emit_notices")
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn(self.user.email, mail.outbox[0].to[0])
+        self.assertIn(self.user2.email, mail.outbox[1].to[0])
+
+    @override_settings(SITE_ID=1)
+    def test_emit_notices_chunked(self):
+        for user in [self.user, self.user2, self.user]:
+            queue([user], "label", sender=self.user)
+        management.call_command("emit_notices", chunk_size=1)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        # batches are sent in the order they were queued
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn(self.user.email, mail.outbox[0].to[0])
+        self.assertIn(self.user2.email, mail.outbox[1].to[0])
+        self.assertIn(self.user.email, mail.outbox[2].to[0])
+
+    def test_group_notices(self):
+        context = {"foo": "bar"}
+        notices = [
+            (1, "label", context, None),
+            (2, "label", {"foo": "bar"}, None),
+            (3, "label", {"foo": "baz"}, None),
+            (4, "other", {"foo": "baz"}, None),
+            (5, "other", {"foo": "baz"}, None),
+        ]
+        self.assertEqual(list(group_notices(notices)), [
+            ([1, 2], "label", context, None),
+            ([3], "label", {"foo": "baz"}, None),
+            ([4, 5], "other", {"foo": "baz"}, None),
+        ])
+
+    @override_settings(SITE_ID=1)
+    def test_send_all_fans_out_once_per_group(self):
+        queue([self.user, self.user2], "label", sender=self.user)
+        calls = []
+        fan_out = models.fan_out
+
+        def recording_fan_out(users, *args):
+            calls.append(list(users))
+            return fan_out(users, *args)
+        models.fan_out = recording_fan_out
+        try:
+            send_all()
+        finally:
+            models.fan_out = fan_out
+        self.assertEqual(calls, [[self.user, self.user2]])
+
+    @override_settings(SITE_ID=1)
+    def test_daemon_max_batches(self):
+        for user in [self.user, self.user2, self.user]:
+            queue([user], "label", sender=self.user)
+        counts = run_daemon(chunk_size=1, max_batches=2)
+        self.assertEqual(counts["batches"], 2)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+
+    @override_settings(SITE_ID=1)
+    def test_emit_audience(self):
+        audiences.register("everyone", lambda: get_user_model().objects.all())
+        queue(audiences.Audience("everyone"), "label", sender=self.user)
         management.call_command("emit_notices")
         self.assertEqual(len(mail.outbox), 2)
-        self.assertIn(self.user.email, mail.outbox[0].to)
-        self.assertIn(self.user2.email, mail.outbox[1].to)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    @override_settings(SITE_ID=1)
+    def test_queryset_batch_split(self):
+        users = [self.user, self.user2] + [
+            get_user_model().objects.create_user("test_user%s" % i, "test%s@user.com" % i, "123")
+            for i in range(3, 6)
+        ]
+        queue(get_user_model().objects.all(), "label", sender=self.user)
+        models.QUEUE_BATCH_SIZE, batch_size = 2, models.QUEUE_BATCH_SIZE
+        try:
+            batch = NoticeQueueBatch.objects.claim("worker", 1)[0]
+            groups = engine.resolve_references(engine.load_batch(batch))
+            self.assertTrue(engine.split_batch(batch, groups))
+            ranges = [
+                list(decode_payload(shard.payload)[0].get_pks())
+                for shard in NoticeQueueBatch.objects.order_by("pk")
+            ]
+            pks = [user.pk for user in users]
+            self.assertEqual(ranges, [pks[:2], pks[2:4], pks[4:]])
+            counts = send_all()
+        finally:
+            models.QUEUE_BATCH_SIZE = batch_size
+        self.assertEqual(counts["batches"], 3)
+        self.assertEqual(sorted(message.to[0].split("<")[-1] for message in mail.outbox),
+                         sorted("%s>" % user.email for user in users))
+
+    def test_audience_split_covers_all(self):
+        get_user_model().objects.create_user("test_user3", "test3@user.com", "123")
+        get_user_model().objects.create_user("test_user4", "test4@user.com", "123")
+        audience = audiences.QueryAudience(get_user_model().objects.all())
+        pks = list(audience.get_pks())
+        for size, expected in ((2, [pks[:2], pks[2:]]), (3, [pks[:3], pks[3:]]), (4, [pks])):
+            self.assertEqual([list(shard.get_pks()) for shard in audience.split(size)], expected)
+        # ranges are not split again
+        self.assertTrue(audience.split(2)[0].is_split())
+        self.assertFalse(audience.is_split())
+
+    @override_settings(SITE_ID=1)
+    def test_send_batch_resumes_from_checkpoint(self):
+        queue([self.user, self.user2], "label", sender=self.user)
+        batch = NoticeQueueBatch.objects.get()
+        # an earlier attempt got through the first recipient
+        batch.checkpoint(0, 1)
+        engine.send_batch(NoticeQueueBatch.objects.get(), engine.new_counts())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.user2.email, mail.outbox[0].to[0])
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    def test_checkpoints(self):
+        engine.CHECKPOINT_INTERVAL, interval = 1, engine.CHECKPOINT_INTERVAL
+        checkpoints = []
+        checkpoint = NoticeQueueBatch.checkpoint
+
+        def recording_checkpoint(batch, index, position):
+            checkpoints.append((index, position))
+            return checkpoint(batch, index, position)
+        NoticeQueueBatch.checkpoint = recording_checkpoint
+        try:
+            queue([self.user, self.user2], "label", sender=self.user)
+            queue(get_user_model().objects.all(), "label", sender=self.user)
+            send_all()
+        finally:
+            NoticeQueueBatch.checkpoint = checkpoint
+            engine.CHECKPOINT_INTERVAL = interval
+        self.assertEqual(checkpoints, [(0, 1), (0, 2), (0, self.user.pk), (0, self.user2.pk)])
+
+    @override_settings(SITE_ID=1)
+    def test_poison_batch(self):
+        poison = NoticeQueueBatch.objects.create(payload=b"NQ\xff\x00")
+        queue([self.user], "label", sender=self.user)
+        counts = send_all()
+        self.assertEqual((counts["batches"], counts["failed"]), (1, 1))
+        self.assertEqual(len(mail.outbox), 1)
+        poison = NoticeQueueBatch.objects.get(pk=poison.pk)
+        self.assertEqual(poison.attempts, 1)
+        self.assertIn("PayloadError", poison.last_error)
+        self.assertGreater(poison.next_attempt, timezone.now())
+        # not retried before its next attempt
+        self.assertEqual(send_all()["failed"], 0)
+
+    def test_dead_letter(self):
+        batch = NoticeQueueBatch.objects.create(
+            payload=b"NQ\xff\x00", attempts=models.QUEUE_MAX_ATTEMPTS
+        )
+        dead_letter = batch.fail("error")
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        self.assertEqual(NoticeQueueDeadLetter.objects.get(), dead_letter)
+        batch = dead_letter.requeue()
+        self.assertEqual((batch.attempts, bytes(batch.payload)), (0, b"NQ\xff\x00"))
+        self.assertEqual(NoticeQueueDeadLetter.objects.count(), 0)
+
+    @override_settings(SITE_ID=1)
+    def test_failing_recipient_is_isolated(self):
+        queue([self.user, self.user2], "label", sender=self.user)
+        fan_out = models.fan_out
+
+        def failing_fan_out(users, *args):
+            if self.user in users:
+                raise ValueError("broken recipient")
+            return fan_out(users, *args)
+        models.fan_out = failing_fan_out
+        try:
+            counts = send_all()
+        finally:
+            models.fan_out = fan_out
+        self.assertEqual((counts["batches"], counts["sent_actual"], counts["failed"]), (1, 1, 1))
+        retry = NoticeQueueBatch.objects.get()
+        self.assertEqual(decode_payload(retry.payload)[0], [self.user.pk])
+        self.assertIn("broken recipient", retry.last_error)
+
+    @override_settings(SITE_ID=1)
+    def test_failing_recipients_dead_lettered(self):
+        users = [self.user, self.user2] + [
+            get_user_model().objects.create_user("test_user%s" % i, "", "123456")
+            for i in range(3, 5)
+        ]
+        queue(users, "label", sender=self.user)
+        failing = users[2:]
+        fan_out = models.fan_out
+
+        def failing_fan_out(recipients, *args):
+            if any(user in failing for user in recipients):
+                raise ValueError("broken recipient")
+            return fan_out(recipients, *args)
+        models.fan_out = failing_fan_out
+        try:
+            for _ in range(models.QUEUE_MAX_ATTEMPTS):
+                counts = send_all()
+                # due again at once
+                NoticeQueueBatch.objects.update(next_attempt=None)
+        finally:
+            models.fan_out = fan_out
+        # the retry batch keeps the attempts of the batch it came from
+        self.assertEqual(counts["batches"], 0)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        dead_letter = NoticeQueueDeadLetter.objects.get()
+        self.assertEqual(decode_payload(dead_letter.payload)[0], [user.pk for user in failing])
+        self.assertIn("broken recipient", dead_letter.last_error)
+
+    @override_settings(SITE_ID=1, TIME_INTERVAL_BTW_TWO_NOTIFICATION=10)
+    def test_smtp_error_retried(self):
+        queue([self.user], "label", sender=self.user2)
+        get_connection = email_backend.get_connection
+        email_backend.get_connection = lambda *args, **kwargs: FailingConnection()
+        try:
+            counts = send_all()
+        finally:
+            email_backend.get_connection = get_connection
+        self.assertEqual((counts["sent_actual"], counts["failed"]), (0, 1))
+        self.assertEqual(len(mail.outbox), 0)
+        # no notice is stored for the failed message, so the retry mails it
+        self.assertFalse(Notice.objects.filter(on_site=False).exists())
+        NoticeQueueBatch.objects.update(next_attempt=None)
+        counts = send_all()
+        self.assertEqual(counts["sent_actual"], 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.user.email, mail.outbox[0].to[0])
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        self.assertEqual(Notice.objects.filter(on_site=False).count(), 1)
+
+    @override_settings(SITE_ID=1, TIME_INTERVAL_BTW_TWO_NOTIFICATION=10)
+    def test_breaker_defers_until_recovered(self):
+        email = breaker.get_breaker("email")
+        email.min_deliveries = 1
+        get_connection = email_backend.get_connection
+        email_backend.get_connection = lambda *args, **kwargs: FailingConnection()
+        try:
+            # the failure opens the breaker, the recipient is deferred
+            self.assertFalse(models.send_now([self.user], "label", sender=self.user2))
+        finally:
+            email_backend.get_connection = get_connection
+        self.assertEqual(email.state, breaker.OPEN)
+        deferred = NoticeQueueBatch.objects.get()
+        self.assertGreater(deferred.next_attempt, timezone.now())
+        self.assertEqual(send_all()["batches"], 0)
+
+        # once the breaker let a probe through, the deferred batch is sent
+        email.opened -= email.open_seconds
+        NoticeQueueBatch.objects.update(next_attempt=None)
+        counts = send_all()
+        self.assertEqual(email.state, breaker.CLOSED)
+        self.assertEqual(counts["sent_actual"], 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(self.user.email, mail.outbox[0].to[0])
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+
+    def test_wakeup(self):
+        listener = wakeup.Listener(("127.0.0.1", 0))
+        try:
+            self.assertFalse(listener.wait(0))
+            wakeup.notify(listener.socket.getsockname())
+            wakeup.notify(listener.socket.getsockname())
+            self.assertTrue(listener.wait(1))
+            # both wake-ups were consumed
+            self.assertFalse(listener.wait(0))
+        finally:
+            listener.close()
+
+
+@unittest.skipUnless(shares_database(), "worker processes need a shared database")
+class TestParallelEmit(TransactionTestCase):
+    def setUp(self):
+        self.users = [
+            get_user_model().objects.create_user("test_user%s" % i, "test%s@user.com" % i, "123456")
+            for i in range(4)
+        ]
+        create_notice_type("label", "display", "past tense", "description")
+
+    @override_settings(SITE_ID=1)
+    def test_send_all_parallel(self):
+        for user in self.users:
+            queue([user], "label", sender=self.users[0])
+        signals = []
+
+        def receiver(sender, **kwargs):
+            signals.append(kwargs)
+        emitted_notices.connect(receiver)
+        try:
+            counts = send_all_parallel(2)
+        finally:
+            emitted_notices.disconnect(receiver)
+        self.assertEqual(counts["batches"], 4)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 0)
+        self.assertEqual(len(signals), 1)
+        self.assertEqual(signals[0]["batches"], 4)
+
+    @override_settings(SITE_ID=1)
+    def test_sigterm_drains_workers(self):
+        for user in self.users * 5:
+            queue([user], "label", sender=self.users[0])
+        parent = os.getpid()
+        fan_out = models.fan_out
+
+        def stopping_fan_out(users, *args):
+            # forked workers inherit the patch and ask the parent to stop
+            os.kill(parent, signal.SIGTERM)
+            return fan_out(users, *args)
+        models.fan_out = stopping_fan_out
+        try:
+            counts = send_all_parallel(2, chunk_size=1)
+        finally:
+            models.fan_out = fan_out
+        # every worker finished the batch at hand, then stopped and gave
+        # up its leases
+        self.assertLess(counts["batches"], 20)
+        self.assertEqual(NoticeQueueBatch.objects.count(), 20 - counts["batches"])
+        self.assertFalse(NoticeQueueBatch.objects.filter(lease_expires__isnull=False).exists())
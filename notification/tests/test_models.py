@@ -1,27 +1,46 @@
 import base64
+import datetime
+import shutil
+import tempfile
+import threading
+import unittest
 
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core import mail
+from django.core.cache import get_cache
+from django.core.management import call_command
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.management.base import CommandError
+from django.utils import timezone
 from django.utils.six.moves import cPickle as pickle  # pylint: disable-msg=F
 
-from ..models import NoticeType, NoticeSetting, NoticeQueueBatch
+from ..models import Notice, NoticeType, NoticeSetting, NoticeQueueBatch
 from ..models import LanguageStoreNotAvailable
 from ..models import get_notification_language, create_notice_type, send_now, send, queue
+from ..models import get_language_code, partition_by_language, get_notification_languages
+from ..models import load_recipients, translate_target
+from .. import models
 from ..compat import get_user_model
+from ..utils import bulk_insert_ignore
+from .. import breaker
+from .. import preferences
+from ..payload import decode_payload, encode_payload, load_batch, PayloadError
+from ..payload import ModelReference, resolve_references
 
 from .models import Language
 
-from . import get_backend_id
+from . import get_backend_id, shares_database
 
 
 class BaseTest(TestCase):
     def setUp(self):
         self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
         self.user2 = get_user_model().objects.create_user("test_user2", "test2@user.com", "123456")
-        create_notice_type("label", "display", "description")
+        create_notice_type("label", "display", "past tense", "description")
         self.notice_type = NoticeType.objects.get(label="label")
 
     def tearDown(self):
@@ -33,24 +52,37 @@ class BaseTest(TestCase):
 class TestNoticeType(TestCase):
     def test_create_notice_type(self):
         label = "friends_invite"
-        create_notice_type(label, "Invitation Received", "you received an invitation")
+        create_notice_type(label, "Invitation Received", "invited you",
+                           "you received an invitation")
         n = NoticeType.objects.get(label=label)
         self.assertEqual(str(n), label)
 
     def test_create(self):
         label = "friends_invite"
-        NoticeType.create(label, "Invitation Received", "you received an invitation", default=2,
-                          verbosity=2)
+        NoticeType.create(label, "Invitation Received", "invited you", "you received an invitation",
+                          default=2, verbosity=2)
         n = NoticeType.objects.get(label=label)
         self.assertEqual(str(n), label)
         # update
-        NoticeType.create(label, "Invitation for you", "you got an invitation", default=1,
-                          verbosity=2)
+        NoticeType.create(label, "Invitation for you", "invited you", "you got an invitation",
+                          default=1, verbosity=2)
         n = NoticeType.objects.get(pk=n.pk)
         self.assertEqual(n.display, "Invitation for you")
         self.assertEqual(n.description, "you got an invitation")
         self.assertEqual(n.default, 1)
 
+    def test_get_cached(self):
+        create_notice_type("cached", "display", "past tense", "description")
+        NoticeType.objects.clear_cache()
+        with self.assertNumQueries(1):
+            notice_type = NoticeType.objects.get_cached("cached")
+            self.assertEqual(NoticeType.objects.get_cached("cached"), notice_type)
+        # saving a notice type invalidates the registry
+        notice_type.state = 0
+        notice_type.save()
+        self.assertEqual(NoticeType.objects.get_cached("cached").state, 0)
+        self.assertRaises(NoticeType.DoesNotExist, NoticeType.objects.get_cached, "missing")
+
 
 class TestNoticeSetting(BaseTest):
     def test_for_user(self):
@@ -66,17 +98,272 @@ class TestNoticeSetting(BaseTest):
                                         medium=email_id)
         self.assertTrue(ns2.send)
 
+    def test_for_user_many(self):
+        email_id = get_backend_id("email")
+        NoticeSetting.objects.create(user=self.user, notice_type=self.notice_type,
+                                     medium=email_id, send=False)
+        user_settings = NoticeSetting.for_user_many(self.user, [self.notice_type])
+        self.assertFalse(user_settings[(self.notice_type.pk, email_id)].send)
+        self.assertEqual(len(user_settings), NoticeSetting.objects.filter(user=self.user).count())
+        self.assertTrue(all(setting.pk for setting in user_settings.values()))
+
+    def test_send_flags(self):
+        email_id = get_backend_id("email")
+        NoticeSetting.objects.create(user=self.user, notice_type=self.notice_type,
+                                     medium=email_id, send=False)
+        with self.assertNumQueries(1):
+            flags = NoticeSetting.send_flags([self.user, self.user2], self.notice_type)
+        self.assertFalse(flags[(self.user.pk, email_id)])
+        # defaults are worked out in memory, not written
+        self.assertTrue(flags[(self.user2.pk, email_id)])
+        self.assertFalse(NoticeSetting.objects.filter(user=self.user2).exists())
+
+    def test_preference_bitmaps(self):
+        email_id = get_backend_id("email")
+        users = [self.user, self.user2]
+        NoticeType.objects.all_cached()
+        with self.assertNumQueries(1):
+            flags = preferences.send_flags(users, self.notice_type)
+        self.assertTrue(flags[(self.user.pk, email_id)])
+        # served from the cache from now on
+        with self.assertNumQueries(0):
+            self.assertTrue(preferences.can_send(self.user, self.notice_type, email_id))
+        # saving a setting invalidates the user's bitmap
+        NoticeSetting.objects.create(user=self.user, notice_type=self.notice_type,
+                                     medium=email_id, send=False)
+        self.assertFalse(preferences.can_send(self.user, self.notice_type, email_id))
+        self.assertTrue(preferences.can_send(self.user2, self.notice_type, email_id))
+
+    def test_preference_cache_timeout(self):
+        # the test settings use the process-local default cache
+        self.assertEqual(preferences.get_cache_timeout(),
+                         min(preferences.PREFERENCE_CACHE_TIMEOUT, preferences.LOCAL_CACHE_TIMEOUT))
+        location = tempfile.mkdtemp()
+        local, preferences.cache = preferences.cache, get_cache(
+            "django.core.cache.backends.filebased.FileBasedCache", LOCATION=location
+        )
+        try:
+            self.assertEqual(preferences.get_cache_timeout(), preferences.PREFERENCE_CACHE_TIMEOUT)
+        finally:
+            preferences.cache = local
+            shutil.rmtree(location)
+
+    @override_settings(NOTIFICATION_SPARSE_SETTINGS=True)
+    def test_sparse_settings(self):
+        email_id = get_backend_id("email")
+        setting = NoticeSetting.for_user(self.user, self.notice_type, email_id)
+        self.assertTrue(setting.send)
+        self.assertFalse(NoticeSetting.objects.filter(user=self.user).exists())
+        # only overrides are stored
+        setting.send = False
+        setting.store()
+        self.assertFalse(NoticeSetting.for_user(self.user, self.notice_type, email_id).send)
+        setting.send = True
+        setting.store()
+        self.assertFalse(NoticeSetting.objects.filter(user=self.user).exists())
+
+    def test_compact_notice_settings(self):
+        email_id = get_backend_id("email")
+        NoticeSetting.objects.create(user=self.user, notice_type=self.notice_type,
+                                     medium=email_id, send=True)
+        NoticeSetting.objects.create(user=self.user2, notice_type=self.notice_type,
+                                     medium=email_id, send=False)
+        self.assertRaises(CommandError, call_command, "compact_notice_settings")
+        call_command("compact_notice_settings", force=True, chunk_size=1)
+        self.assertEqual(
+            list(NoticeSetting.objects.values_list("user", flat=True)), [self.user2.pk]
+        )
+
+    def test_compact_keeps_changed_settings(self):
+        email_id = get_backend_id("email")
+        setting = NoticeSetting.objects.create(user=self.user, notice_type=self.notice_type,
+                                               medium=email_id, send=True)
+        get_default = NoticeSetting.get_default
+
+        def changing_get_default(notice_type, medium):
+            # the user overrides the default after the settings were read
+            NoticeSetting.objects.filter(pk=setting.pk).update(send=False)
+            return get_default(notice_type, medium)
+        NoticeSetting.get_default = staticmethod(changing_get_default)
+        try:
+            call_command("compact_notice_settings", force=True)
+        finally:
+            NoticeSetting.get_default = staticmethod(get_default)
+        self.assertFalse(NoticeSetting.objects.get(pk=setting.pk).send)
+
+
+@unittest.skipUnless(shares_database(), "needs a database shared with other threads")
+class TestNoticeSettingConcurrency(TransactionTestCase):
+    threads = 8
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        create_notice_type("label", "display", "past tense", "description")
+        self.notice_type = NoticeType.objects.get(label="label")
+
+    def run_threads(self, target):
+        errors = []
+        barrier = threading.Event()
+
+        def worker():
+            barrier.wait()
+            try:
+                target()
+            except Exception as e:  # pylint: disable-msg=W0703
+                errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=worker) for i in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_for_user(self):
+        email_id = get_backend_id("email")
+        errors = self.run_threads(
+            lambda: NoticeSetting.for_user(self.user, self.notice_type, email_id)
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(NoticeSetting.objects.filter(user=self.user).count(), 1)
+
+    def test_for_user_many(self):
+        errors = self.run_threads(
+            lambda: NoticeSetting.for_user_many(self.user, [self.notice_type])
+        )
+        self.assertEqual(errors, [])
+        self.assertEqual(
+            NoticeSetting.objects.filter(user=self.user).count(), len(models.NOTICE_MEDIA)
+        )
+
+
+class TestNoticeQueueBatch(TestCase):
+    def test_claim(self):
+        for i in range(3):
+            NoticeQueueBatch.objects.create(pickled_data="")
+        first = NoticeQueueBatch.objects.claim("worker-1", 2)
+        second = NoticeQueueBatch.objects.claim("worker-2", 2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(NoticeQueueBatch.objects.claim("worker-3", 2), [])
+        self.assertEqual(first[0].attempts, 1)
+
+    def test_expired_lease(self):
+        batch = NoticeQueueBatch.objects.create(pickled_data="")
+        NoticeQueueBatch.objects.claim("worker-1", 1)
+        NoticeQueueBatch.objects.filter(pk=batch.pk).update(
+            lease_expires=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(NoticeQueueBatch.objects.extend("worker-1", [batch.pk]), set())
+        claimed = NoticeQueueBatch.objects.claim("worker-2", 1)
+        self.assertEqual([(b.pk, b.claimed_by, b.attempts) for b in claimed],
+                         [(batch.pk, "worker-2", 2)])
+        NoticeQueueBatch.objects.release("worker-2")
+        self.assertEqual(NoticeQueueBatch.objects.claim("worker-1", 1), [batch])
+
+    def test_release_is_not_an_attempt(self):
+        NoticeQueueBatch.objects.create(pickled_data="")
+        for i in range(models.QUEUE_MAX_ATTEMPTS):
+            NoticeQueueBatch.objects.claim("worker-1", 1)
+            NoticeQueueBatch.objects.release("worker-1")
+        batch, = NoticeQueueBatch.objects.claim("worker-1", 1)
+        self.assertEqual(batch.attempts, 1)
+        # a first real failure is retried rather than dead lettered
+        self.assertIsNone(batch.fail("error"))
+        self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+
+
+class TestPayload(TestCase):
+    def test_round_trip(self):
+        user_ids = list(range(1, 1000))
+        data = encode_payload(user_ids, "label", {"foo": "bar"}, None)
+        self.assertEqual(decode_payload(data), (user_ids, "label", {"foo": "bar"}, None))
+        # large payloads are compressed
+        self.assertLess(len(data), len(user_ids) * 8)
+        data = encode_payload(["a", "b"], "label", {}, None)
+        self.assertEqual(decode_payload(data)[0], ["a", "b"])
+        self.assertRaises(PayloadError, decode_payload, b"XX\x01\x00")
+
+    def test_model_references(self):
+        user = get_user_model().objects.create_user("test_user", "test@user.com", "123456")
+        create_notice_type("label", "display", "past tense", "description")
+        notice_type = NoticeType.objects.get(label="label")
+        data = encode_payload([user.pk], "label", {"target": notice_type, "foo": "bar"}, user)
+        user_ids, label, extra_context, sender = decode_payload(data)
+        self.assertIsInstance(extra_context["target"], ModelReference)
+        self.assertIsInstance(sender, ModelReference)
+        # one query per content type for any number of notices
+        notices = [(user_ids, label, extra_context, sender)] * 3
+        with self.assertNumQueries(2):
+            resolved = resolve_references(notices)
+        self.assertEqual(resolved[2],
+                         ([user.pk], "label", {"target": notice_type, "foo": "bar"}, user))
+
+    def test_load_legacy_batch(self):
+        notices = [(1, "label", {}, None), (2, "label", {}, None)]
+        batch = NoticeQueueBatch(pickled_data=base64.b64encode(pickle.dumps(notices)))
+        self.assertEqual(load_batch(batch), [([1, 2], "label", {}, None)])
+
+
+class TestNotice(BaseTest):
+    def make_notice(self, recipient):
+        return Notice(recipient=recipient, sender=self.user2, notice_type=self.notice_type,
+                      message="message", target_url="http://example.com/", on_site=True, site_id=1)
+
+    @override_settings(TIME_INTERVAL_BTW_TWO_NOTIFICATION=10)
+    def test_dedupe_key(self):
+        now = timezone.now()
+        key = self.make_notice(self.user).get_dedupe_key(now)
+        self.assertEqual(key, self.make_notice(self.user).get_dedupe_key(now))
+        self.assertNotEqual(key, self.make_notice(self.user2).get_dedupe_key(now))
+        later = now + datetime.timedelta(minutes=10)
+        self.assertNotEqual(key, self.make_notice(self.user).get_dedupe_key(later))
+
+    @override_settings(TIME_INTERVAL_BTW_TWO_NOTIFICATION=10)
+    def test_bulk_insert_ignores_duplicates(self):
+        now = timezone.now()
+        notices = [
+            self.make_notice(self.user), self.make_notice(self.user), self.make_notice(self.user2)
+        ]
+        for notice in notices:
+            notice.dedupe_key = notice.get_dedupe_key(now)
+        inserted = bulk_insert_ignore(Notice, notices, 10, ("dedupe_key",))
+        self.assertEqual(len(inserted), 2)
+        self.assertEqual(Notice.objects.count(), 2)
+
+        # replaying the same notices reads the existing keys and inserts nothing
+        replay = [self.make_notice(self.user), self.make_notice(self.user2)]
+        for notice in replay:
+            notice.dedupe_key = notice.get_dedupe_key(now)
+        with self.assertNumQueries(1):
+            self.assertEqual(bulk_insert_ignore(Notice, replay, 10, ("dedupe_key",)), [])
+
+        # a clash the lookup does not see, as with a concurrent writer, is
+        # retried row by row and leaves the enclosing transaction usable
+        fresh = self.make_notice(self.user)
+        fresh.target_url = "http://example.com/other/"
+        fresh.dedupe_key = fresh.get_dedupe_key(now)
+        with transaction.atomic():
+            self.assertEqual(bulk_insert_ignore(Notice, replay + [fresh], 10, ("id",)), [fresh])
+            self.assertEqual(Notice.objects.count(), 3)
+
 
 class TestProcedures(BaseTest):
     def setUp(self):
         super(TestProcedures, self).setUp()
-        self.lang = Language.objects.create(user=self.user, language="en_US")
+        self.lang = Language.objects.create(user=self.user, default_language="en_US")
+        models._language_cache.clear()  # pylint: disable-msg=W0212
         mail.outbox = []
+        breaker.reset()
 
     def tearDown(self):
         super(TestProcedures, self).tearDown()
         self.lang.delete()
         NoticeQueueBatch.objects.all().delete()
+        breaker.reset()
 
     @override_settings(NOTIFICATION_LANGUAGE_MODULE="tests.Language")
     def test_get_notification_language(self):
@@ -85,42 +372,154 @@ class TestProcedures(BaseTest):
         del settings.NOTIFICATION_LANGUAGE_MODULE
         self.assertRaises(LanguageStoreNotAvailable, get_notification_language, self.user)
 
+    @override_settings(NOTIFICATION_LANGUAGE_MODULE="tests.Language")
+    def test_get_notification_languages(self):
+        user_ids = [self.user.pk, self.user2.pk]
+        with self.assertNumQueries(1):
+            languages = get_notification_languages(user_ids)
+        self.assertEqual(list(languages), [self.user.pk])
+        # both the hit and the miss are cached
+        with self.assertNumQueries(0):
+            self.assertEqual(get_notification_languages(user_ids), languages)
+
+    def test_load_recipients(self):
+        with self.assertNumQueries(1):
+            users = load_recipients([self.user.pk, self.user2.pk, -1])
+        self.assertEqual(users, {self.user.pk: self.user, self.user2.pk: self.user2})
+
+    def test_get_language_code(self):
+        code, name = settings.LANGUAGES[0]
+        self.assertEqual(get_language_code(code), code)
+        self.assertEqual(get_language_code(name), code)
+        self.assertEqual(get_language_code("no-such-language"), "en")
+
+    def test_partition_by_language(self):
+        users = [self.user, self.user2]
+        self.assertEqual(partition_by_language(users, {"language_code": "en"}), [("en", users)])
+        self.assertEqual(partition_by_language(users, {}), [(None, users)])
+
+    def test_translate_target(self):
+        class Translations(object):
+            def get(self, language_code):
+                if language_code != "de":
+                    raise ObjectDoesNotExist
+                return Target("Titel")
+
+        class Target(object):
+            translations = Translations()
+
+            def __init__(self, title):
+                self.title = title
+        target = Target("Title")
+        translate_target(target, "de", "Title")
+        self.assertEqual(target.title, "Titel")
+        # without a translation the original title is used
+        translate_target(target, "fr", "Title")
+        self.assertEqual(target.title, "Title")
+
     @override_settings(SITE_ID=1, NOTIFICATION_LANGUAGE_MODULE="tests.Language")
     def test_send_now(self):
         Site.objects.create(domain="localhost", name="localhost")
         users = [self.user, self.user2]
-        send_now(users, "label")
+        send_now(users, "label", sender=self.user)
         self.assertEqual(len(mail.outbox), 2)
-        self.assertIn(self.user.email, mail.outbox[0].to)
-        self.assertIn(self.user2.email, mail.outbox[1].to)
+        self.assertIn(self.user.email, mail.outbox[0].to[0])
+        self.assertIn(self.user2.email, mail.outbox[1].to[0])
+
+    @override_settings(SITE_ID=1, NOTIFICATION_LANGUAGE_MODULE="tests.Language")
+    def test_send_now_keeps_stored_language(self):
+        # not in settings.LANGUAGES, Django falls back to "de" by itself
+        self.lang.default_language = "de-at"
+        self.lang.save()
+        activated = []
+        for backend in models.NOTIFICATION_BACKENDS.values():
+            def activate_language(language_code, extra_context, backend=backend):
+                activated.append(language_code)
+                type(backend).activate_language(backend, language_code, extra_context)
+            backend.activate_language = activate_language
+        try:
+            send_now([self.user], "label", sender=self.user2)
+        finally:
+            for backend in models.NOTIFICATION_BACKENDS.values():
+                del backend.activate_language
+        self.assertEqual(set(activated), set(["de-at"]))
+
+    @override_settings(SITE_ID=1, TIME_INTERVAL_BTW_TWO_NOTIFICATION=10)
+    def test_send_now_duplicate(self):
+        with transaction.atomic():
+            send_now([self.user], "label", sender=self.user2)
+            send_now([self.user], "label", sender=self.user2)
+            self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Notice.objects.filter(recipient=self.user).count(), 1)
+
+    @override_settings(SITE_ID=1)
+    def test_send_now_breaker_open(self):
+        email = breaker.get_breaker("email")
+        for _ in range(email.min_deliveries):
+            email.record(False, 0)
+        self.assertEqual(email.state, breaker.OPEN)
+        self.assertFalse(send_now([self.user, self.user2], "label", sender=self.user))
+        self.assertEqual(len(mail.outbox), 0)
+        # the recipients are queued again, to be sent once the breaker recovers
+        batch = NoticeQueueBatch.objects.get()
+        self.assertGreater(batch.next_attempt, timezone.now())
+        self.assertEqual(decode_payload(batch.payload)[0], [self.user.pk, self.user2.pk])
 
     @override_settings(SITE_ID=1)
     def test_send(self):
         self.assertRaises(AssertionError, send, queue=True, now=True)
 
         users = [self.user, self.user2]
-        send(users, "label", now=True)
+        send(users, "label", now=True, sender=self.user)
         self.assertEqual(len(mail.outbox), 2)
-        self.assertIn(self.user.email, mail.outbox[0].to)
-        self.assertIn(self.user2.email, mail.outbox[1].to)
+        self.assertIn(self.user.email, mail.outbox[0].to[0])
+        self.assertIn(self.user2.email, mail.outbox[1].to[0])
 
-        send(users, "label", queue=True)
+        send(users, "label", queue=True, sender=self.user)
         self.assertEqual(NoticeQueueBatch.objects.count(), 1)
         batch = NoticeQueueBatch.objects.all()[0]
-        notices = pickle.loads(base64.b64decode(batch.pickled_data))
-        self.assertEqual(len(notices), 2)
+        user_ids, label, extra_context, sender = decode_payload(batch.payload)
+        self.assertEqual(user_ids, [self.user.pk, self.user2.pk])
 
     @override_settings(SITE_ID=1)
     def test_send_default(self):
         # default behaviout, send_now
         users = [self.user, self.user2]
-        send(users, "label")
+        send(users, "label", sender=self.user)
         self.assertEqual(len(mail.outbox), 2)
         self.assertEqual(NoticeQueueBatch.objects.count(), 0)
 
+    def test_queue_shards(self):
+        models.QUEUE_BATCH_SIZE, batch_size = 1, models.QUEUE_BATCH_SIZE
+        try:
+            with self.assertNumQueries(1):
+                queue([self.user, self.user2], "label", sender=self.user)
+        finally:
+            models.QUEUE_BATCH_SIZE = batch_size
+        self.assertEqual(
+            [decode_payload(batch.payload)[0] for batch in NoticeQueueBatch.objects.order_by("pk")],
+            [[self.user.pk], [self.user2.pk]]
+        )
+
     @override_settings(SITE_ID=1)
     def test_queue_queryset(self):
         users = get_user_model().objects.all()
-        queue(users, "label")
+        with self.assertNumQueries(1):
+            queue(users, "label", sender=self.user)
         self.assertEqual(len(mail.outbox), 0)
         self.assertEqual(NoticeQueueBatch.objects.count(), 1)
+        # only the query is stored, users are looked up when sending
+        audience = decode_payload(NoticeQueueBatch.objects.get().payload)[0]
+        self.assertEqual(list(audience.iter_chunks(1)), [[self.user.pk], [self.user2.pk]])
+
+    @override_settings(SITE_ID=1)
+    def test_queue_sliced_queryset(self):
+        users = get_user_model().objects.order_by("pk")
+        # these cannot be reordered or filtered by the worker, so the
+        # recipients are stored instead of the query
+        queue(users[:1], "label", sender=self.user)
+        queue(users.distinct(), "label", sender=self.user)
+        self.assertEqual(
+            [decode_payload(batch.payload)[0] for batch in NoticeQueueBatch.objects.order_by("pk")],
+            [[self.user.pk], [self.user.pk, self.user2.pk]]
+        )
@@ -18,9 +18,9 @@ class TestViews(TestCase):
                              target_status_code=404)
 
     def test_notice_settings(self):
-        create_notice_type("label_1", "display", "description")
+        create_notice_type("label_1", "display", "past tense", "description")
         notice_type_1 = NoticeType.objects.get(label="label_1")
-        create_notice_type("label_2", "display", "description")
+        create_notice_type("label_2", "display", "past tense", "description")
         notice_type_2 = NoticeType.objects.get(label="label_2")
         email_id = get_backend_id("email")
         setting = NoticeSetting.for_user(self.user, notice_type_2, email_id)
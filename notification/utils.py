@@ -0,0 +1,87 @@
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+
+
+def chunks(iterable, size):
+    """
+    Yields successive lists of at most ``size`` items from ``iterable``.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_insert_ignore(model, objs, size, unique):
+    """
+    Inserts ``objs`` with ``bulk_create`` in chunks of ``size``, silently
+    skipping those whose values of the ``unique`` fields are already taken,
+    and returns the list of objects which were actually inserted. Objects
+    with a None in those fields are always inserted.
+
+    Each chunk costs one query for the rows that already exist and one
+    insert. Only a chunk which still clashes, because a concurrent writer
+    got in between, is retried row by row. Every insert runs in its own
+    atomic block so a clash does not break an enclosing transaction.
+    """
+    attnames = [model._meta.get_field(name).attname for name in unique]  # pylint: disable-msg=W0212
+
+    def key(obj):
+        return tuple(getattr(obj, attname) for attname in attnames)
+
+    inserted = []
+    for chunk in chunks(objs, size):
+        existing = _existing_keys(model, [obj for obj in chunk if None not in key(obj)], unique)
+        fresh = []
+        for obj in chunk:
+            obj_key = key(obj)
+            if None not in obj_key:
+                if obj_key in existing:
+                    continue
+                # also drop duplicates within the chunk
+                existing.add(obj_key)
+            fresh.append(obj)
+        if fresh:
+            inserted.extend(_insert_ignore(model, fresh))
+    return inserted
+
+
+def _existing_keys(model, objs, unique):
+    """
+    Returns the set of ``unique`` value tuples of ``objs`` already stored.
+    """
+    if not objs:
+        return set()
+    meta = model._meta  # pylint: disable-msg=W0212
+    fields = [(name, meta.get_field(name).attname) for name in unique]
+    lookup = dict(
+        ("%s__in" % name, set(getattr(obj, attname) for obj in objs)) for name, attname in fields
+    )
+    manager = model._default_manager  # pylint: disable-msg=W0212
+    return set(manager.filter(**lookup).values_list(*unique))
+
+
+def _insert_ignore(model, objs):
+    """
+    Inserts ``objs`` at once, or one by one if that clashes, and returns
+    the objects which were inserted.
+    """
+    try:
+        with transaction.atomic():
+            model._default_manager.bulk_create(objs)  # pylint: disable-msg=W0212
+        return objs
+    except IntegrityError:
+        pass
+    inserted = []
+    for obj in objs:
+        try:
+            with transaction.atomic():
+                obj.save(force_insert=True)
+        except IntegrityError:
+            pass
+        else:
+            inserted.append(obj)
+    return inserted
@@ -4,6 +4,7 @@ from django.template import RequestContext
 
 from django.contrib.auth.decorators import login_required
 
+from notification import preferences
 from notification.models import NoticeSetting, NoticeType, NOTICE_MEDIA
 
 
@@ -27,29 +28,33 @@ def notice_settings(request):
             value is ``True`` or ``False`` depending on a ``request.POST``
             variable called ``form_label``, whose valid value is ``on``.
     """
-    notice_types = NoticeType.objects.filter(state=1).order_by('display')
-    if request.user.is_staff:
-        notice_types = NoticeType.objects.filter(state__gte=1).order_by('display')
+    notice_types = [
+        notice_type for notice_type in NoticeType.objects.all_cached()
+        if notice_type.state == 1 or (request.user.is_staff and notice_type.state >= 1)
+    ]
+    notice_types.sort(key=lambda notice_type: notice_type.display)
 
+    user_settings = NoticeSetting.for_user_many(request.user, notice_types)
     settings_table = []
     for notice_type in notice_types:
         settings_row = []
         for medium_id, medium_display in NOTICE_MEDIA:
             form_label = "%s_%s" % (notice_type.label, medium_id)
-            setting = NoticeSetting.for_user(request.user, notice_type, medium_id)
+            setting = user_settings[(notice_type.pk, medium_id)]
             if request.method == "POST":
                 if request.POST.get(form_label) == "on":
                     if not setting.send:
                         setting.send = True
-                        setting.save()
+                        setting.store()
                 else:
                     if setting.send:
                         setting.send = False
-                        setting.save()
+                        setting.store()
             settings_row.append((form_label, setting.send))
         settings_table.append({"notice_type": notice_type, "cells": settings_row})
 
     if request.method == "POST":
+        preferences.invalidate(request.user.pk)
         next_page = request.POST.get("next_page", ".")
         return HttpResponseRedirect(next_page)
 
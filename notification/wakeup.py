@@ -0,0 +1,59 @@
+"""
+Wakes idle ``emit_notices --daemon`` processes as soon as notices are queued.
+
+``queue`` sends a single UDP datagram to NOTIFICATION_WAKEUP_ADDRESS, where
+a daemon on the same host listens between polls. Datagrams nobody receives
+are simply lost, in which case the daemon picks the work up on its next poll.
+"""
+import select
+import socket
+
+from django.conf import settings
+
+
+WAKEUP_ADDRESS = getattr(settings, "NOTIFICATION_WAKEUP_ADDRESS", None)
+
+
+def notify(address=None):
+    """
+    Wakes the daemon listening at ``address``, if any. Never raises.
+    """
+    address = address or WAKEUP_ADDRESS
+    if not address:
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(b"1", tuple(address))
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+
+
+class Listener(object):
+
+    def __init__(self, address=None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(tuple(address or WAKEUP_ADDRESS))
+        self.socket.setblocking(False)
+
+    def wait(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for a wake-up and returns whether one
+        arrived. Wake-ups which piled up meanwhile are consumed as well.
+        """
+        try:
+            readable = select.select([self.socket], [], [], timeout)[0]
+        except (select.error, OSError):
+            # interrupted by a signal
+            return False
+        if not readable:
+            return False
+        while True:
+            try:
+                self.socket.recv(64)
+            except socket.error:
+                return True
+
+    def close(self):
+        self.socket.close()
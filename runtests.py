@@ -1,4 +1,6 @@
+import os
 import sys
+import tempfile
 
 from django.conf import settings
 
@@ -8,6 +10,11 @@ settings.configure(
     DATABASES={
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
+            # a file rather than memory, so that the tests for concurrent
+            # writers and worker processes share one database
+            "TEST_NAME": os.path.join(
+                tempfile.gettempdir(), "notification-tests-%s.sqlite3" % os.getpid()
+            ),
         }
     },
     ROOT_URLCONF="notification.urls",
@@ -19,6 +26,10 @@ settings.configure(
         "notification",
         "notification.tests",
     ],
+    SITE_ID=1,
+    PRODUCTION_SETTING=True,
+    DEVELOPMENT_SERVER=False,
+    DEFAULT_PROFILE_PHOTO="",
     STRIPE_PUBLIC_KEY="",
     STRIPE_SECRET_KEY="",
     PAYMENTS_PLANS={},
@@ -26,7 +37,7 @@ settings.configure(
 
 from django_nose import NoseTestSuiteRunner
 
-test_runner = NoseTestSuiteRunner(verbosity=1)
+test_runner = NoseTestSuiteRunner(verbosity=1, interactive=False)
 failures = test_runner.run_tests(["notification"])
 
 if failures: